@@ -0,0 +1,69 @@
+"""
+バックエンド(代わりのサーバー)の数を変えて、拡張の速さがどれだけ上がるかを比べる
+
+    python benchmarks/backend_pool.py --backends 1 2 4 --bands 4
+
+高さ--bands × 生成サイズのキャンバスを右に--steps回拡張する(1回の拡張の帯は、空いているバックエンドで同時に生成される)。
+最後の行は、使えるバックエンドに加えて、接続できないURLを1つ混ぜた場合(別のバックエンドで生成し直す)
+"""
+import argparse
+import asyncio
+import socket
+import sys
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from canvas import TiledCanvas
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion
+
+
+def _unused_url() -> str:
+    "誰も待ち受けていないURL"
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return f'http://127.0.0.1:{port}/sdapi/v1/'
+
+
+def _run(urls:list[str], args:argparse.Namespace) -> tuple[float, StableDiffusion]:
+    stable_diffusion = StableDiffusion(urls)
+    canvas = TiledCanvas(sample_image(args.size).resize((args.size, args.size * args.bands)))
+    async def _expand():
+        for _ in range(args.steps):
+            await stable_diffusion.expand_generatively(canvas, args.generate_width, Direction.RIGHT, args.size, dict(mask_blur=8))
+    started = time.perf_counter()
+    asyncio.run_coroutine_threadsafe(_expand(), stable_diffusion.event_loop).result()
+    return time.perf_counter() - started, stable_diffusion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', type=int, nargs='*', default=[1, 2, 4], help='バックエンドの数')
+    parser.add_argument('--bands', type=int, default=4, help='1回の拡張の帯の数')
+    parser.add_argument('--steps', type=int, default=3, help='拡張する回数')
+    parser.add_argument('--size', type=int, default=512, help='生成サイズ')
+    parser.add_argument('--generate-width', type=int, default=128)
+    parser.add_argument('--generation-seconds', type=float, default=0.5)
+    args = parser.parse_args()
+
+    n_images = args.bands * args.steps
+    print(f'{"backends":>9} {"seconds":>8} {"images/s":>9} {"speedup":>8} {"failovers":>10} {"per backend":>12}')
+    with ExitStack() as stack:
+        servers = [ stack.enter_context(FakeWebUI(generation_seconds=args.generation_seconds)) for _ in range(max(args.backends)) ]
+        baseline = None
+        rows = [ (f'{n}', [ server.url for server in servers[:n] ]) for n in args.backends ]
+        rows.append((f'{max(args.backends)}+dead', [_unused_url()] + [ server.url for server in servers[:max(args.backends)] ]))
+        for label, urls in rows:
+            seconds, stable_diffusion = _run(urls, args)
+            baseline = baseline or seconds
+            per_backend = '/'.join(str(backend.n_generated) for backend in stable_diffusion.backends)
+            print(f'{label:>9} {seconds:8.2f} {n_images / seconds:9.2f} {baseline / seconds:7.2f}x {stable_diffusion.n_failovers:10} {per_backend:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+生成の中止をリクエストしてから止まるまでの時間を、変更前の方法と現在の方法で比較する
+
+    python benchmarks/cancel_latency.py --interrupt-seconds 2
+
+before: 変更前と同じく/interruptだけを送り、生成結果が返ってきて継ぎ足すのを待つ
+after:  StableDiffusion.cancel_generation。タスクをキャンセルしてレスポンスを捨て、/interruptも送る
+代わりのサーバーは、中止されてから--interrupt-seconds(実行中のステップとVAEのデコードの代わり)だけ経ってから結果を返す
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from canvas import TiledCanvas
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion
+
+
+async def _measure(stable_diffusion:StableDiffusion, mode:str, size:int, cancel_after:float) -> float:
+    canvas = TiledCanvas(sample_image(size))
+    task = asyncio.create_task(stable_diffusion.expand_generatively(canvas, 128, Direction.RIGHT, size, dict(mask_blur=8)))
+    await asyncio.sleep(cancel_after)
+    started = time.perf_counter()
+    if mode == 'before':
+        await stable_diffusion.interrupt_generation()
+        await task
+    else:
+        await stable_diffusion.cancel_generation(task)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--generation-seconds', type=float, default=10.0)
+    parser.add_argument('--interrupt-seconds', type=float, default=2.0)
+    parser.add_argument('--cancel-after', type=float, default=0.5, help='生成を始めてから中止するまでの秒数')
+    parser.add_argument('--size', type=int, default=512, help='生成サイズ')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"mode":>7} {"cancel-to-idle ms":>18}')
+    with FakeWebUI(generation_seconds=args.generation_seconds, interrupt_seconds=args.interrupt_seconds) as server:
+        stable_diffusion = StableDiffusion(server.url)
+        for mode in ('before', 'after'):
+            seconds = []
+            for _ in range(args.repeat):
+                seconds.append(asyncio.run_coroutine_threadsafe(_measure(stable_diffusion, mode, args.size, args.cancel_after), stable_diffusion.event_loop).result())
+                # サーバーが中止した生成を片付けるのを待つ
+                time.sleep(args.interrupt_seconds)
+            print(f'{mode:>7} {statistics.median(seconds) * 1000:18.1f}')
+
+
+if __name__ == '__main__':
+    main()
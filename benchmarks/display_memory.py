@@ -0,0 +1,87 @@
+"""
+画像を表示するときのピークメモリ(RSS)を、変更前の処理と現在のCanvasViewで比較する
+
+    python benchmarks/display_memory.py --width 50000 --height 512
+
+before: 変更前のMainFrame.set_imageと同じく、PILの画像全体をtobytes()してwx.Image経由でビットマップに変換する
+after:  CanvasViewにTiledCanvasを設定し、見えている部分のタイルだけをバッファから直接ビットマップにする
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+STRIP_WIDTH = 512
+
+
+def _current_rss_kib() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+def _peak_rss_kib() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(mode:str, width:int, height:int):
+    "1つのモードを計測して「ベースライン ピーク」をKiB単位で出力する(プロセスごとに1回だけ呼ぶ)"
+    import numpy as np
+    import wx
+    from PIL import Image
+
+    from canvas import TiledCanvas
+    from sd_outpainting_gui import CanvasView
+
+    app = wx.App()
+    strip = np.random.default_rng(0).integers(0, 256, (height, STRIP_WIDTH, 3), np.uint8)
+
+    # 一時的な確保でピークが上がらないように、細長い帯を継ぎ足して画像を作る
+    if mode == 'before':
+        image = Image.new('RGB', (width, height))
+        strip_image = Image.fromarray(strip)
+        for x in range(0, width, STRIP_WIDTH):
+            image.paste(strip_image, (x, 0))
+    else:
+        canvas = TiledCanvas()
+        for x in range(0, width, STRIP_WIDTH):
+            canvas.paste(strip[:, :min(STRIP_WIDTH, width - x)], (x, 0))
+        frame = wx.Frame(None, size=wx.Size(800, 600))
+        view = CanvasView(frame)
+        frame.Show()
+        wx.SafeYield()
+
+    baseline = _current_rss_kib()
+    if mode == 'before':
+        bitmap = wx.ImageFromBuffer(image.width, image.height, image.tobytes()).ConvertToBitmap()
+    else:
+        view.set_image(canvas)
+        view.Update()
+        wx.SafeYield()
+    print(baseline, _peak_rss_kib())
+    app.ExitMainLoop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width',  type=int, default=50000)
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--mode', choices=['before', 'after'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        _measure(args.mode, args.width, args.height)
+        return
+
+    print(f'画像サイズ: {args.width}x{args.height} (RGB {args.width * args.height * 3 / 2**20:.1f} MiB)')
+    for mode in ('before', 'after'):
+        output = subprocess.run([sys.executable, __file__, '--mode', mode, '--width', str(args.width), '--height', str(args.height)], check=True, capture_output=True, text=True).stdout
+        baseline, peak = map(int, output.split()[-2:])
+        print(f'{mode:>6}: ピークRSS {peak / 1024:8.1f} MiB (表示処理による増加 {(peak - baseline) / 1024:8.1f} MiB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+生成リクエストで送る画像とマスクのエンコード方法(stable_diffusion.ENCODING_PROFILES)を比較する。
+プロファイルごとに、エンコードにかかる時間・送信するデータの大きさ・ローカルの代わりのサーバーとの往復時間を表示する
+
+    python benchmarks/encoding.py --image photo.png --repeat 10
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+from PIL import Image
+
+from fake_webui import FakeWebUI
+from stable_diffusion import ENCODING_PROFILES, Direction, StableDiffusion, base64_length, encode_image, encode_mask, generate_mask, pad_image
+
+
+def sample_image(size:int) -> Image.Image:
+    "写真の代わりに、なめらかなグラデーションにノイズを乗せた画像"
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    rgb = np.stack([x, y, (x + y) / 2], axis=-1) * 255
+    rgb += np.random.default_rng(0).normal(0, 8, rgb.shape)
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', help='手がかりに使う画像(省略時は合成した画像)')
+    parser.add_argument('--size', type=int, default=512, help='生成サイズ')
+    parser.add_argument('--generate-width', type=int, default=192)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--profiles', nargs='*', default=list(ENCODING_PROFILES), choices=list(ENCODING_PROFILES))
+    args = parser.parse_args()
+
+    size, generate_width = args.size, args.generate_width
+    image = Image.open(args.image).convert('RGB') if args.image else sample_image(size)
+    context = image.resize((size, size)).crop((generate_width, 0, size, size))
+    padded = pad_image(context, Direction.RIGHT, size)
+    mask = generate_mask(context.width - 16, Direction.RIGHT, size)
+
+    print(f'{"profile":<14} {"encode ms":>10} {"image KiB":>10} {"mask KiB":>9} {"round trip ms":>14}')
+    with FakeWebUI() as server:
+        stable_diffusion = StableDiffusion(server.url)
+        for name in args.profiles:
+            profile = ENCODING_PROFILES[name]
+
+            encode_times = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                image_data = encode_image(padded, profile)
+                mask_data = encode_mask(mask, profile)
+                encode_times.append(time.perf_counter() - started)
+
+            stable_diffusion.encoding = profile
+            round_trips = []
+            for _ in range(args.repeat):
+                # 同じ手がかりなのでキャッシュが効いてしまう
+                stable_diffusion.init_image_cache.clear()
+                stable_diffusion.mask_cache.clear()
+                started = time.perf_counter()
+                asyncio.run_coroutine_threadsafe(stable_diffusion._generate(context, Direction.RIGHT, mask_blur=8, image_size=size), stable_diffusion.event_loop).result()
+                round_trips.append(time.perf_counter() - started)
+
+            print(f'{name:<14} {statistics.median(encode_times) * 1000:10.1f} {base64_length(len(image_data)) / 1024:10.1f} {base64_length(len(mask_data)) / 1024:9.2f} {statistics.median(round_trips) * 1000:14.1f}')
+
+
+if __name__ == '__main__':
+    main()
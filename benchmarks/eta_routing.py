@@ -0,0 +1,78 @@
+"""
+速さの違うバックエンドや、他の人の生成で埋まっているバックエンドがあるときの拡張の時間を、
+空いているものに振り分ける場合(least_loaded)と、最も早く終わりそうなものに振り分ける場合(eta)で比較する
+
+    python benchmarks/eta_routing.py --fast-seconds 0.25 --slow-seconds 1.0 --bands 3
+
+mixed: 速いバックエンドと遅いバックエンド(生成時間--fast-secondsと--slow-seconds)で、高さ--bands × 生成サイズのキャンバスを--steps回拡張する
+busy:  同じ速さのバックエンド2つのうち1つが、拡張のたびに他の人の生成(--external-seconds)で埋まっている
+--logを指定すると、振り分けの理由(1行に1つのJSON)をそのファイルに書き出す
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from canvas import TiledCanvas
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion
+
+
+def _run(generation_seconds:list[float], external_seconds:float, route_by_eta:bool, args:argparse.Namespace) -> tuple[float, StableDiffusion]:
+    "(拡張にかかった秒数の合計, StableDiffusion)を返す"
+    with ExitStack() as stack:
+        servers = [ stack.enter_context(FakeWebUI(generation_seconds=seconds)) for seconds in generation_seconds ]
+        stable_diffusion = StableDiffusion([ server.url for server in servers ], route_by_eta=route_by_eta, hedge_percentile=None)
+        canvas = TiledCanvas(sample_image(args.size).resize((args.size, args.size * args.bands)))
+        elapsed = 0.0
+        for _ in range(args.steps):
+            if external_seconds:
+                servers[0].occupy(external_seconds)
+            started = time.perf_counter()
+            coroutine = stable_diffusion.expand_generatively(canvas, args.generate_width, Direction.RIGHT, args.size, dict(mask_blur=8))
+            asyncio.run_coroutine_threadsafe(coroutine, stable_diffusion.event_loop).result()
+            elapsed += time.perf_counter() - started
+            # 他の人の生成が終わるのを待つ
+            time.sleep(max(0.0, external_seconds - (time.perf_counter() - started)))
+        return elapsed, stable_diffusion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fast-seconds', type=float, default=0.25)
+    parser.add_argument('--slow-seconds', type=float, default=1.0)
+    parser.add_argument('--external-seconds', type=float, default=3.0, help='busyで他の人の生成にかかる時間')
+    parser.add_argument('--bands', type=int, default=3, help='1回の拡張の帯の数')
+    parser.add_argument('--steps', type=int, default=4, help='拡張する回数')
+    parser.add_argument('--size', type=int, default=256, help='生成サイズ')
+    parser.add_argument('--generate-width', type=int, default=64)
+    parser.add_argument('--log', help='振り分けの理由を書き出すファイル')
+    args = parser.parse_args()
+
+    if args.log is not None:
+        handler = logging.FileHandler(args.log, 'w', encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        routing = logging.getLogger('stable_diffusion.routing')
+        routing.addHandler(handler)
+        routing.setLevel(logging.INFO)
+
+    scenarios = {
+        'mixed': ([args.fast_seconds, args.slow_seconds], 0.0),
+        'busy':  ([args.fast_seconds, args.fast_seconds], args.external_seconds),
+    }
+    print(f'{"scenario":>9} {"routing":>13} {"seconds":>8} {"s/step":>7} {"per backend":>12}')
+    for scenario, (generation_seconds, external_seconds) in scenarios.items():
+        for route_by_eta in (False, True):
+            elapsed, stable_diffusion = _run(generation_seconds, external_seconds, route_by_eta, args)
+            per_backend = '/'.join(str(backend.n_generated) for backend in stable_diffusion.backends)
+            print(f'{scenario:>9} {"eta" if route_by_eta else "least_loaded":>13} {elapsed:8.2f} {elapsed / args.steps:7.2f} {per_backend:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+ベンチマーク用の、Stable Diffusion Web UI APIの代わりになるサーバー。
+img2imgは受け取った画像とマスクをデコードし、generation_seconds + seconds_per_megapixel × 生成サイズ(メガピクセル)だけ待って
+(生成したふりをして)初期画像をそのまま返す。inpaint_full_resの場合はWeb UIと同じく初期画像の大きさで返す。
+中止されると、interrupt_seconds(実行中のステップとVAEのデコードの代わり)だけ待ってから結果を返す。
+model_load_secondsを指定すると、最初の生成だけモデルの読み込みの分だけ余計に待つ。
+stall_probabilityを指定すると、その確率で生成がstall_secondsだけ余計にかかる(VRAMのスワップや他の人の生成の代わり)。
+checkpointとvaeは読み込んでいるモデルで、optionsで返す。override_settingsで違うモデルを指定されると、model_switch_secondsだけかけて読み込み直し、
+Web UIと同じく(override_settings_restore_afterwardsがFalseでなければ)生成の後にもう一度かけて元に戻す。
+bandwidthを指定すると、送受信をその速さ(バイト/秒)に制限して遅い回線を再現する。
+レスポンスはWeb UIのGZipMiddlewareと同じく、1000バイト以上ならgzipで圧縮する。gzip_requestsならgzipで圧縮したリクエストボディも受け付ける
+
+    with FakeWebUI(generation_seconds=0.5) as server:
+        stable_diffusion = StableDiffusion(server.url)
+"""
+import base64
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Any, Optional
+
+from PIL import Image
+
+
+class FakeWebUI:
+    generation_seconds:     float
+    seconds_per_megapixel:  float # 生成の時間のうち、生成サイズに比例する部分
+    model_load_seconds:     float # 最初の生成で余計にかかる時間
+    interrupt_seconds:      float # 中止されてから結果を返すまでの時間
+    stall_probability:      float # 生成が遅くなる確率
+    stall_seconds:          float # 遅くなったときに余計にかかる時間
+    checkpoint:             str   # 読み込んでいるモデル
+    vae:                    str
+    model_switch_seconds:   float # モデルを読み込み直す時間
+    bandwidth:              Optional[float] # 送受信の速さ(バイト/秒)。Noneなら制限しない
+    gzip_requests:          bool # Content-Encoding: gzipのリクエストボディを受け付ける(Web UIは受け付けない)
+    server:             ThreadingHTTPServer
+    thread:             Optional[threading.Thread] = None
+
+    n_requests:     int = 0 # img2imgのリクエスト数
+    bytes_received: int = 0 # img2imgのリクエストボディの合計(圧縮されていれば圧縮後)
+    bytes_sent:     int = 0 # img2imgのレスポンスボディの合計(圧縮していれば圧縮後)
+    n_model_switches: int = 0 # モデルを読み込み直した回数(元に戻したのも含む)
+
+    _job_started:  Optional[float] = None
+    _job_seconds:  float = 0.0
+    _model_loaded: bool = False
+    _interrupted:  threading.Event
+    _gpu:          threading.Lock # Web UIと同じく、生成は1つずつ行う
+    _random:       random.Random
+    _lock:         threading.Lock
+
+    def __init__(self, host:str='127.0.0.1', port:int=0, generation_seconds:float=0.0, seconds_per_megapixel:float=0.0, model_load_seconds:float=0.0, interrupt_seconds:float=0.0, bandwidth:Optional[float]=None, gzip_requests:bool=False,
+                 stall_probability:float=0.0, stall_seconds:float=0.0, seed:Optional[int]=None,
+                 checkpoint:str='fake.safetensors', vae:str='Automatic', model_switch_seconds:float=0.0):
+        self.generation_seconds = generation_seconds
+        self.seconds_per_megapixel = seconds_per_megapixel
+        self.model_load_seconds = model_load_seconds
+        self.interrupt_seconds = interrupt_seconds
+        self.stall_probability = stall_probability
+        self.stall_seconds = stall_seconds
+        self._random = random.Random(seed)
+        self.checkpoint = checkpoint
+        self.vae = vae
+        self.model_switch_seconds = model_switch_seconds
+        self.bandwidth = bandwidth
+        self.gzip_requests = gzip_requests
+        self._interrupted = threading.Event()
+        self._gpu = threading.Lock()
+        self._lock = threading.Lock()
+
+        fake = self
+        class _Handler(_FakeWebUIHandler):
+            server_state = fake
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/sdapi/v1/'
+
+    def start(self) -> 'FakeWebUI':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name='FakeWebUI')
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'FakeWebUI':
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def img2img(self, payload:dict[str, Any]) -> dict[str, Any]:
+        "生成したふりをする"
+        image = decode_image(payload['init_images'][0])
+        if payload.get('mask'):
+            decode_image(payload['mask'])
+
+        width, height = payload.get('width', image.width), payload.get('height', image.height)
+        seconds = self._seconds(width, height)
+        override = payload.get('override_settings') or {}
+        with self._gpu:
+            if self._random.random() < self.stall_probability:
+                seconds += self.stall_seconds
+            if not self._model_loaded:
+                seconds += self.model_load_seconds
+                self._model_loaded = True
+            previous = (self.checkpoint, self.vae)
+            self._switch_model(override.get('sd_model_checkpoint', self.checkpoint), override.get('sd_vae', self.vae))
+            self._run_job(seconds)
+            if payload.get('override_settings_restore_afterwards', True):
+                self._switch_model(*previous)
+
+        image = image.convert('RGB')
+        if not payload.get('inpaint_full_res'):
+            image = image.resize((width, height))
+        bio = BytesIO()
+        image.save(bio, 'png')
+        return dict(images=[base64.b64encode(bio.getbuffer()).decode('ascii')], parameters={}, info='{}')
+
+    def occupy(self, seconds:float):
+        "他の人の生成の代わりに、secondsだけGPUを使う。別のスレッドで実行し、始まったら返る"
+        started = threading.Event()
+        def _occupy():
+            with self._gpu:
+                self._run_job(seconds, started)
+        threading.Thread(target=_occupy, daemon=True, name='FakeWebUI-occupy').start()
+        started.wait()
+
+    def _run_job(self, seconds:float, started:Optional[threading.Event]=None):
+        "GPUを使っている間に呼ぶ。中止されるかseconds経つまで待つ(進行状況に表示される)"
+        with self._lock:
+            self._interrupted.clear()
+            self._job_started = time.perf_counter()
+            self._job_seconds = seconds
+        if started is not None:
+            started.set()
+        if self._interrupted.wait(seconds):
+            time.sleep(self.interrupt_seconds)
+        with self._lock:
+            self._job_started = None
+
+    def _switch_model(self, checkpoint:str, vae:str):
+        "GPUを使っている間に呼ぶ。違うモデルならmodel_switch_secondsだけかけて読み込む"
+        if (checkpoint, vae) != (self.checkpoint, self.vae):
+            time.sleep(self.model_switch_seconds)
+            with self._lock:
+                self.checkpoint, self.vae = checkpoint, vae
+                self.n_model_switches += 1
+
+    def _seconds(self, width:int, height:int) -> float:
+        return self.generation_seconds + self.seconds_per_megapixel * width * height / 1e6
+
+    def progress(self) -> dict[str, Any]:
+        with self._lock:
+            started, seconds = self._job_started, self._job_seconds
+        if started is None:
+            return dict(progress=0, eta_relative=0, state=dict(job_count=0), current_image=None)
+        elapsed = time.perf_counter() - started
+        progress = min(1.0, elapsed / seconds) if seconds > 0 else 1.0
+        return dict(progress=progress, eta_relative=max(0.0, seconds - elapsed), state=dict(job_count=1), current_image=None)
+
+    def interrupt(self):
+        self._interrupted.set()
+
+    def transfer(self, n_bytes:int):
+        "n_bytesを送受信するのにかかる時間だけ待つ"
+        if self.bandwidth:
+            time.sleep(n_bytes / self.bandwidth)
+
+
+def decode_image(b64:str) -> Image.Image:
+    if b64.startswith('data:'):
+        b64 = b64.split(',', 1)[1]
+    image = Image.open(BytesIO(base64.b64decode(b64)))
+    image.load()
+    return image
+
+
+class _FakeWebUIHandler(BaseHTTPRequestHandler):
+    server_state: FakeWebUI
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # ヘッダーとボディを別々に送るので、遅延ACKを待たないようにする(Web UIのuvicornと同じ)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        "送られてきたままの(圧縮されていれば圧縮された)リクエストボディ"
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    body = b''.join(chunks)
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server_state.transfer(len(body))
+        return body
+
+    def _decode_body(self, body:bytes) -> Optional[Any]:
+        "リクエストボディのJSON。読めなければ(Web UIと同じく)422を返してNone"
+        try:
+            if self.headers.get('Content-Encoding', '').lower() == 'gzip' and self.server_state.gzip_requests:
+                body = gzip.decompress(body)
+            return json.loads(body)
+        except ValueError:
+            self._send_json(dict(detail=[ dict(type='json_invalid', msg='JSON decode error') ]), 422)
+            return None
+
+    def _send_json(self, obj:Any, status:int=200) -> int:
+        "JSONを返す。送ったボディの大きさ(圧縮していれば圧縮後)を返す"
+        body = json.dumps(obj).encode('utf-8')
+        compress = len(body) >= 1000 and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if compress:
+            body = gzip.compress(body, 6)
+        self.server_state.transfer(len(body))
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            if compress:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントがキャンセルして接続を閉じた
+            self.close_connection = True
+        return len(body)
+
+    def do_GET(self):
+        state = self.server_state
+        match self.path.split('?')[0]:
+            case '/sdapi/v1/progress':   self._send_json(state.progress())
+            case '/sdapi/v1/samplers':   self._send_json([ dict(name=name) for name in ('Euler', 'Euler a', 'Heun', 'DPM++ 2M') ])
+            case '/sdapi/v1/schedulers': self._send_json([ dict(name=name) for name in ('Automatic', 'Karras', 'Exponential') ])
+            case '/sdapi/v1/options':    self._send_json(dict(sd_model_checkpoint=state.checkpoint, sd_vae=state.vae))
+            case _:                      self._send_json(dict(detail='Not Found'), 404)
+
+    def do_POST(self):
+        state = self.server_state
+        body = self._read_body()
+        match self.path.split('?')[0]:
+            case '/sdapi/v1/img2img':
+                payload = self._decode_body(body)
+                if payload is None:
+                    return
+                n_sent = self._send_json(state.img2img(payload))
+                with state._lock:
+                    state.n_requests += 1
+                    state.bytes_received += len(body)
+                    state.bytes_sent += n_sent
+            case '/sdapi/v1/interrupt':
+                state.interrupt()
+                self._send_json(None)
+            case '/sdapi/v1/png-info':
+                if self._decode_body(body) is not None:
+                    self._send_json(dict(info='', items={}, parameters={}))
+            case _:
+                self._send_json(dict(detail='Not Found'), 404)
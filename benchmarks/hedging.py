@@ -0,0 +1,64 @@
+"""
+ときどき生成が止まる(遅くなる)バックエンドを複数使ったときの1回の生成時間の分布と、送った生成リクエストの数を、ヘッジの有無で比較する
+
+    python benchmarks/hedging.py --backends 3 --stall-probability 0.02 --stall-seconds 3
+
+代わりのサーバーは、--stall-probabilityの確率で生成に--stall-secondsだけ余計にかかる。
+ヘッジする場合は、最近の生成時間の--percentile分位を過ぎたら、同じ生成を空いている別のバックエンドにも依頼する
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion, percentile
+
+
+def _run(args:argparse.Namespace, hedge_percentile:Optional[float]) -> tuple[list[float], int, StableDiffusion]:
+    "(生成ごとの秒数, サーバーが受け取った生成リクエストの数, StableDiffusion)を返す"
+    context = sample_image(args.size).crop((args.size // 4, 0, args.size, args.size))
+    with ExitStack() as stack:
+        servers = [ stack.enter_context(FakeWebUI(generation_seconds=args.generation_seconds, stall_probability=args.stall_probability, stall_seconds=args.stall_seconds, seed=seed))
+                    for seed in range(args.backends) ]
+        stable_diffusion = StableDiffusion([ server.url for server in servers ], hedge_percentile=hedge_percentile)
+        async def _steps() -> list[float]:
+            seconds = []
+            for _ in range(args.steps):
+                started = time.perf_counter()
+                await stable_diffusion._generate(context, Direction.RIGHT, mask_blur=8, image_size=args.size)
+                seconds.append(time.perf_counter() - started)
+            # ヘッジで負けた生成が止まるのを待つ
+            await asyncio.sleep(0.5)
+            return seconds
+        seconds = asyncio.run_coroutine_threadsafe(_steps(), stable_diffusion.event_loop).result()
+        return seconds, sum(server.n_requests for server in servers), stable_diffusion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', type=int, default=3, help='バックエンドの数')
+    parser.add_argument('--steps', type=int, default=200, help='生成する回数')
+    parser.add_argument('--size', type=int, default=256, help='生成サイズ')
+    parser.add_argument('--generation-seconds', type=float, default=0.1)
+    parser.add_argument('--stall-probability', type=float, default=0.02)
+    parser.add_argument('--stall-seconds', type=float, default=3.0)
+    parser.add_argument('--percentile', type=float, default=0.95, help='ヘッジするまでの時間に使う分位')
+    args = parser.parse_args()
+
+    print(f'{"hedging":>8} {"p50 s":>7} {"p95 s":>7} {"p99 s":>7} {"max s":>7} {"requests/step":>14} {"hedges":>7} {"hedge wins":>11}')
+    for hedge_percentile in (None, args.percentile):
+        seconds, n_requests, stable_diffusion = _run(args, hedge_percentile)
+        print(f'{"off" if hedge_percentile is None else f"p{hedge_percentile * 100:g}":>8} {statistics.median(seconds):7.2f} {percentile(seconds, 0.95):7.2f} {percentile(seconds, 0.99):7.2f} {max(seconds):7.2f} '
+              f'{n_requests / args.steps:14.2f} {stable_diffusion.n_hedges:7} {stable_diffusion.n_hedge_wins:11}')
+
+
+if __name__ == '__main__':
+    main()
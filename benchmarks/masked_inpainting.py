@@ -0,0 +1,58 @@
+"""
+1回の拡張にかかる秒数を、生成範囲全体を生成する場合とマスクの部分だけを生成する場合(only_masked)で比較する
+
+    python benchmarks/masked_inpainting.py                                  # 代わりのサーバー
+    python benchmarks/masked_inpainting.py --url http://127.0.0.1:7860/sdapi/v1/ --steps 20
+
+--urlを省略した場合は、生成時間が生成サイズに比例する代わりのサーバー(--seconds-per-megapixel)を使う
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from canvas import TiledCanvas
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import DEFAULT_OPTIONS, Direction, StableDiffusion
+
+
+def _run(stable_diffusion:StableDiffusion, args:argparse.Namespace):
+    options = DEFAULT_OPTIONS | dict(steps=args.steps)
+    print(f'{"mode":<22} {"s/step p50":>11} {"s/step min":>11}')
+    for only_masked, padding in [ (False, 0) ] + [ (True, padding) for padding in args.paddings ]:
+        canvas = TiledCanvas(sample_image(args.size))
+        seconds = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            coroutine = stable_diffusion.expand_generatively(canvas, args.generate_width, Direction.RIGHT, args.size, options | dict(only_masked=only_masked, only_masked_padding=padding))
+            asyncio.run_coroutine_threadsafe(coroutine, stable_diffusion.event_loop).result()
+            seconds.append(time.perf_counter() - started)
+        mode = f'only masked (pad {padding})' if only_masked else 'full frame'
+        print(f'{mode:<22} {statistics.median(seconds):11.2f} {min(seconds):11.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='Stable Diffusion Web UI APIのURL(省略時は代わりのサーバー)')
+    parser.add_argument('--size', type=int, default=512, help='生成サイズ')
+    parser.add_argument('--generate-width', type=int, default=128)
+    parser.add_argument('--paddings', type=int, nargs='*', default=[32, 64, 128], help='only_maskedで加える手がかりの幅')
+    parser.add_argument('--steps', type=int, default=20, help='サンプリングのステップ数')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seconds-per-megapixel', type=float, default=4.0, help='代わりのサーバーの生成時間')
+    args = parser.parse_args()
+
+    if args.url is not None:
+        _run(StableDiffusion(args.url), args)
+    else:
+        with FakeWebUI(seconds_per_megapixel=args.seconds_per_megapixel) as server:
+            _run(StableDiffusion(server.url), args)
+
+
+if __name__ == '__main__':
+    main()
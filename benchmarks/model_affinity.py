@@ -0,0 +1,64 @@
+"""
+モデル(チェックポイント)を指定した生成を複数のバックエンドに振り分けたときの、モデルの読み込み直しの回数と時間を、
+読み込んでいるモデルを考えて振り分ける場合(model_affinity)と考えない場合で比較する
+
+    python benchmarks/model_affinity.py --jobs 12 --model-switch-seconds 2
+
+loaded: バックエンドが1つずつ別のモデルを読み込んでいて、生成は2つのモデルを交互に指定する(Web UIは生成の後に元のモデルに戻す)
+keep:   どのバックエンドも指定されないモデルを読み込んでいて、生成の後に元に戻させない(keep_model_loaded)
+どちらも--jobs個の生成をまとめて依頼する(空くのを待つ生成がモデルごとに分かれる)
+"""
+import argparse
+import asyncio
+import sys
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion
+
+
+MODELS = ['anime.safetensors', 'photo.safetensors']
+
+
+def _run(loaded:list[str], keep_model_loaded:bool, model_affinity:bool, args:argparse.Namespace) -> tuple[float, int, StableDiffusion]:
+    "(かかった秒数, サーバーがモデルを読み込み直した回数, StableDiffusion)を返す"
+    context = sample_image(args.size).crop((args.size // 4, 0, args.size, args.size))
+    with ExitStack() as stack:
+        servers = [ stack.enter_context(FakeWebUI(generation_seconds=args.generation_seconds, checkpoint=checkpoint, model_switch_seconds=args.model_switch_seconds)) for checkpoint in loaded ]
+        stable_diffusion = StableDiffusion([ server.url for server in servers ], model_affinity=model_affinity, keep_model_loaded=keep_model_loaded,
+                                           model_switch_seconds=args.model_switch_seconds, hedge_percentile=None)
+        async def _jobs():
+            await asyncio.gather(*[ stable_diffusion._generate(context, Direction.RIGHT, mask_blur=8, image_size=args.size, override_settings=dict(sd_model_checkpoint=MODELS[i % len(MODELS)]))
+                                    for i in range(args.jobs) ])
+        started = time.perf_counter()
+        asyncio.run_coroutine_threadsafe(_jobs(), stable_diffusion.event_loop).result()
+        return time.perf_counter() - started, sum(server.n_model_switches for server in servers), stable_diffusion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=12, help='まとめて依頼する生成の数')
+    parser.add_argument('--size', type=int, default=256, help='生成サイズ')
+    parser.add_argument('--generation-seconds', type=float, default=0.2)
+    parser.add_argument('--model-switch-seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    scenarios = {
+        'loaded': (MODELS, False),
+        'keep':   (['base.safetensors'] * len(MODELS), True),
+    }
+    print(f'{"scenario":>9} {"affinity":>9} {"seconds":>8} {"server switches":>16} {"avoided":>8} {"per backend":>12}')
+    for scenario, (loaded, keep_model_loaded) in scenarios.items():
+        for model_affinity in (False, True):
+            seconds, n_switches, stable_diffusion = _run(loaded, keep_model_loaded, model_affinity, args)
+            per_backend = '/'.join(str(backend.n_generated) for backend in stable_diffusion.backends)
+            print(f'{scenario:>9} {"on" if model_affinity else "off":>9} {seconds:8.2f} {n_switches:16} {stable_diffusion.n_model_switches_avoided:8} {per_backend:>12}')
+
+
+if __name__ == '__main__':
+    main()
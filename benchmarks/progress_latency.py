@@ -0,0 +1,69 @@
+"""
+生成中に進行状況の取得がどれだけ遅れるかを、画像処理をイベントループのスレッドで行う場合とワーカーで行う場合で比較する
+
+    python benchmarks/progress_latency.py --height 8192 --size 1024
+
+元の解像度を保つ設定で、高さheightのキャンバスを右に拡張する(手がかりの縮小と生成結果の拡大が重い)。
+その間、イベントループで--intervalごとに進行状況を取得し、予定からの遅れを記録する
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from canvas import TiledCanvas
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion
+
+
+async def _measure(stable_diffusion:StableDiffusion, canvas:TiledCanvas, size:int, generate_width:int, interval:float) -> tuple[float, list[float]]:
+    "(拡張にかかった秒数, 進行状況の取得の遅れ(秒)のリスト)を返す"
+    done = False
+    delays = []
+    async def _poll():
+        while not done:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            delays.append(time.perf_counter() - expected)
+            await stable_diffusion.get_generation_progress()
+    poller = asyncio.create_task(_poll())
+
+    started = time.perf_counter()
+    await stable_diffusion.expand_generatively(canvas, generate_width, Direction.RIGHT, size, dict(mask_blur=8), resample=True)
+    elapsed = time.perf_counter() - started
+    done = True
+    await poller
+    return elapsed, delays
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--height', type=int, default=8192, help='キャンバスの高さ')
+    parser.add_argument('--size', type=int, default=1024, help='生成サイズ')
+    parser.add_argument('--generate-width', type=int, default=192)
+    parser.add_argument('--generation-seconds', type=float, default=0.5)
+    parser.add_argument('--interval', type=float, default=0.05, help='進行状況を取得する間隔(秒)')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    source = sample_image(args.size).resize((args.height, args.height))
+    print(f'{"workers":>8} {"seconds":>8} {"delay p50 ms":>13} {"delay p95 ms":>13} {"delay max ms":>13}')
+    with FakeWebUI(generation_seconds=args.generation_seconds) as server:
+        stable_diffusion = StableDiffusion(server.url)
+        for workers in (0, args.workers):
+            stable_diffusion.workers = ThreadPoolExecutor(workers) if workers else None
+            canvas = TiledCanvas(source)
+            elapsed, delays = asyncio.run_coroutine_threadsafe(_measure(stable_diffusion, canvas, args.size, args.generate_width, args.interval), stable_diffusion.event_loop).result()
+            delays.sort()
+            p95 = delays[min(len(delays) - 1, int(len(delays) * 0.95))]
+            print(f'{workers:8} {elapsed:8.2f} {statistics.median(delays) * 1000:13.1f} {p95 * 1000:13.1f} {delays[-1] * 1000:13.1f}')
+
+
+if __name__ == '__main__':
+    main()
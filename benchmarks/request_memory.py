@@ -0,0 +1,67 @@
+"""
+生成リクエスト1回分の送受信にかかるピークメモリ(tracemalloc)と時間を、変更前の処理と現在の処理で比較する
+
+    python benchmarks/request_memory.py --sizes 1024 1536 2048
+
+before: 変更前のStableDiffusion._generateと同じく、base64の文字列を含むJSONを丸ごと作って送り、レスポンスも丸ごと読んでパースする
+after:  StableDiffusion._generate。JSONを少しずつ送り、レスポンスの画像も少しずつbase64デコードする
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image
+
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion, base64_to_image, generate_mask, image_to_base64, pad_image
+
+
+async def _generate_before(stable_diffusion:StableDiffusion, img:Image.Image, image_size:int, mask_blur:int=8) -> Image.Image:
+    response = await stable_diffusion.backends[0].client.post('img2img', timeout=60*30, json=dict(
+        init_images=[image_to_base64(pad_image(img, Direction.RIGHT, image_size))],
+        mask=image_to_base64(generate_mask(img.width - 2*mask_blur, Direction.RIGHT, image_size)),
+        mask_blur=mask_blur,
+        width=image_size,
+        height=image_size,
+    ))
+    response.raise_for_status()
+    return base64_to_image(response.json()['images'][0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1024, 1536, 2048], help='生成サイズ')
+    parser.add_argument('--generate-width', type=int, default=192)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"size":>6} {"mode":>7} {"peak MiB":>9} {"ms":>9}')
+    with FakeWebUI() as server:
+        stable_diffusion = StableDiffusion(server.url)
+        for size in args.sizes:
+            context = sample_image(size).crop((args.generate_width, 0, size, size))
+            for mode in ('before', 'after'):
+                peaks, times = [], []
+                for _ in range(args.repeat):
+                    if mode == 'before':
+                        coroutine = _generate_before(stable_diffusion, context, size)
+                    else:
+                        coroutine = stable_diffusion._generate(context, Direction.RIGHT, mask_blur=8, image_size=size)
+                    tracemalloc.start()
+                    started = time.perf_counter()
+                    asyncio.run_coroutine_threadsafe(coroutine, stable_diffusion.event_loop).result().load()
+                    times.append(time.perf_counter() - started)
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+                print(f'{size:6} {mode:>7} {max(peaks) / 2**20:9.1f} {statistics.median(times) * 1000:9.1f}')
+
+
+if __name__ == '__main__':
+    main()
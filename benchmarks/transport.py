@@ -0,0 +1,46 @@
+"""
+遅い回線を再現した代わりのサーバーに対して、生成リクエスト1回の送受信量と時間を、圧縮の有無で比較する
+
+    python benchmarks/transport.py --bandwidth 2 --size 768
+
+StableDiffusion.transfersに記録された、実際に送受信したバイト数(圧縮後)を表示する
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bandwidth', type=float, default=2.0, help='回線の速さ(MB/秒)')
+    parser.add_argument('--size', type=int, default=768, help='生成サイズ')
+    parser.add_argument('--generate-width', type=int, default=192)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    context = sample_image(args.size).crop((args.generate_width, 0, args.size, args.size))
+    print(f'{"request":>8} {"response":>9} {"sent KiB":>9} {"received KiB":>13} {"ms":>8}')
+    with FakeWebUI(bandwidth=args.bandwidth * 1e6, gzip_requests=True) as server:
+        stable_diffusion = StableDiffusion(server.url)
+        backend = stable_diffusion.backends[0]
+        for compress_requests, compress_responses in [ (False, False), (False, True), (True, True) ]:
+            backend.compress_requests = compress_requests
+            backend.client.headers['Accept-Encoding'] = 'gzip' if compress_responses else 'identity'
+            stable_diffusion.transfers.clear()
+            for _ in range(args.repeat):
+                asyncio.run_coroutine_threadsafe(stable_diffusion._generate(context, Direction.RIGHT, mask_blur=8, image_size=args.size), stable_diffusion.event_loop).result()
+            transfers = list(stable_diffusion.transfers)
+            print(f'{"gzip" if compress_requests else "plain":>8} {"gzip" if compress_responses else "plain":>9} '
+                  f'{transfers[-1].sent / 1024:9.1f} {transfers[-1].received / 1024:13.1f} {statistics.median(t.seconds for t in transfers) * 1000:8.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+キャンバスへの継ぎ足し中に、GUIのスレッドの代わりのスレッドがどれだけ待たされるか(GILの取り合い)を、
+キャンバスを同じプロセスに置く場合(TiledCanvas)と別のプロセスに置く場合(CanvasWorker)で比較する
+
+    python benchmarks/ui_latency.py --heights 2048 8192
+
+元の解像度を保つ設定で、高さheightのキャンバスを右に拡張する(手がかりの縮小と生成結果の拡大・継ぎ足しが重い)。
+その間、メインスレッドで--intervalごとに眠り、予定からの遅れを記録する
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from canvas import Canvas, TiledCanvas
+from canvas_worker import CanvasWorker
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion
+
+
+def _measure(stable_diffusion:StableDiffusion, canvas:Canvas, size:int, generate_width:int, interval:float, repeat:int) -> list[float]:
+    "メインスレッドが眠ってから起きるまでの遅れ(秒)のリストを返す"
+    future = asyncio.run_coroutine_threadsafe(_expand(stable_diffusion, canvas, size, generate_width, repeat), stable_diffusion.event_loop)
+    delays = []
+    while not future.done():
+        expected = time.perf_counter() + interval
+        time.sleep(interval)
+        delays.append(time.perf_counter() - expected)
+    future.result()
+    return delays
+
+async def _expand(stable_diffusion:StableDiffusion, canvas:Canvas, size:int, generate_width:int, repeat:int):
+    for _ in range(repeat):
+        await stable_diffusion.expand_generatively(canvas, generate_width, Direction.RIGHT, size, dict(mask_blur=8), resample=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--heights', type=int, nargs='*', default=[2048, 8192], help='キャンバスの高さ')
+    parser.add_argument('--size', type=int, default=512, help='生成サイズ')
+    parser.add_argument('--generate-width', type=int, default=128)
+    parser.add_argument('--interval', type=float, default=0.01, help='メインスレッドが眠る間隔(秒)')
+    parser.add_argument('--repeat', type=int, default=3, help='1回の計測で拡張する回数')
+    args = parser.parse_args()
+
+    print(f'{"height":>7} {"canvas":>12} {"delay p50 ms":>13} {"delay p95 ms":>13} {"delay max ms":>13}')
+    with FakeWebUI() as server:
+        stable_diffusion = StableDiffusion(server.url)
+        for height in args.heights:
+            source = sample_image(args.size).resize((height, height))
+            for canvas_class in (TiledCanvas, CanvasWorker):
+                canvas = canvas_class(source)
+                delays = sorted(_measure(stable_diffusion, canvas, args.size, args.generate_width, args.interval, args.repeat))
+                p95 = delays[min(len(delays) - 1, int(len(delays) * 0.95))]
+                print(f'{height:7} {canvas_class.__name__:>12} {statistics.median(delays) * 1000:13.1f} {p95 * 1000:13.1f} {delays[-1] * 1000:13.1f}')
+                if isinstance(canvas, CanvasWorker):
+                    canvas.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+最初の生成と2回目以降の生成にかかる時間を、ウォームアップ(StableDiffusion.warm_up)の有無で比較する
+
+    python benchmarks/warm_up.py --model-load-seconds 3
+
+代わりのサーバーは、最初の生成だけモデルの読み込みの分(--model-load-seconds)だけ余計に時間がかかる
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from encoding import sample_image
+from fake_webui import FakeWebUI
+from stable_diffusion import Direction, StableDiffusion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-load-seconds', type=float, default=3.0)
+    parser.add_argument('--generation-seconds', type=float, default=0.5)
+    parser.add_argument('--size', type=int, default=512, help='生成サイズ')
+    parser.add_argument('--steps', type=int, default=4, help='計測する生成の回数')
+    args = parser.parse_args()
+
+    context = sample_image(args.size).crop((192, 0, args.size, args.size))
+    print(f'{"warm-up":>8} {"warm-up s":>10} {"first s":>8} {"steady s":>9}')
+    for warm_up in (False, True):
+        with FakeWebUI(generation_seconds=args.generation_seconds, model_load_seconds=args.model_load_seconds) as server:
+            stable_diffusion = StableDiffusion(server.url)
+            def _run(coroutine):
+                return asyncio.run_coroutine_threadsafe(coroutine, stable_diffusion.event_loop).result()
+
+            warm_up_seconds = _run(stable_diffusion.warm_up()) if warm_up else 0.0
+            seconds = []
+            for _ in range(args.steps):
+                started = time.perf_counter()
+                _run(stable_diffusion._generate(context, Direction.RIGHT, mask_blur=8, image_size=args.size))
+                seconds.append(time.perf_counter() - started)
+            print(f'{"on" if warm_up else "off":>8} {warm_up_seconds:10.2f} {seconds[0]:8.2f} {statistics.median(seconds[1:]):9.2f}')
+
+
+if __name__ == '__main__':
+    main()
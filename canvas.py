@@ -0,0 +1,651 @@
+import bisect
+import math
+from abc import ABC, abstractmethod
+import tempfile
+import threading
+import weakref
+import zlib
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import IO, Optional, TypeVar
+
+import numpy as np
+from PIL import Image
+
+
+Box = tuple[int, int, int, int] # (left, top, right, bottom)
+
+
+def union_box(a:Box, b:Box) -> Box:
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def intersect_box(a:Box, b:Box) -> Optional[Box]:
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if box[0] < box[2] and box[1] < box[3]:
+        return box
+
+TileKey = tuple[int, int] # (列, 行)
+
+def scale_box(box:Box, level:int) -> Box:
+    "1/2**levelに縮小した座標で、boxを含む範囲"
+    left, top, right, bottom = box
+    return (left >> level, top >> level, -(-right >> level), -(-bottom >> level))
+
+def tile_box(key:TileKey, tile_size:int) -> Box:
+    return (key[0]*tile_size, key[1]*tile_size, (key[0]+1)*tile_size, (key[1]+1)*tile_size)
+
+def tile_keys(box:Box, tile_size:int) -> list[TileKey]:
+    "boxと重なるタイルの位置"
+    left, top, right, bottom = box
+    return [ (tx, ty) for ty in range(top//tile_size, -(-bottom//tile_size)) for tx in range(left//tile_size, -(-right//tile_size)) ]
+
+def to_array(image:Image.Image | np.ndarray) -> np.ndarray:
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert('RGB'))
+    return image
+
+
+def downsample(source:'Canvas', target:'Canvas', box:Box, level:int, chunk_size:int=256) -> Box:
+    """
+    sourceのboxの範囲を1/2**levelに縮小してtargetに書き込む。書き込んだ範囲(targetの座標)を返す。
+    描画されていない画素は平均に含めず、縮小後に描画済みの画素を含まない部分は書き込まない
+    """
+    scaled = scale_box(box, level)
+    factor = 1 << level
+    # 一度に切り出す範囲が縮小前の座標でchunk_size程度になるように区切る
+    for key in tile_keys(scaled, max(16, chunk_size >> level)):
+        left, top, right, bottom = intersect_box(tile_box(key, max(16, chunk_size >> level)), scaled) # type: ignore
+        region = (left*factor, top*factor, right*factor, bottom*factor)
+        painted = source.query_bbox(region)
+        if painted is None:
+            continue
+        pixels = source.crop(region).reshape(bottom - top, factor, right - left, factor, 3).astype(np.uint32)
+        mask = source.painted_mask(region)
+        if mask.all():
+            reduced = (pixels.sum(axis=(1, 3)) >> (level*2)).astype(np.uint8)
+        else:
+            mask = mask.reshape(bottom - top, factor, right - left, factor, 1)
+            counts = mask.sum(axis=(1, 3), dtype=np.uint32)
+            reduced = ((pixels * mask).sum(axis=(1, 3)) // np.maximum(counts, 1)).astype(np.uint8)
+        pl, pt, pr, pb = intersect_box(scale_box(painted, level), (left, top, right, bottom)) # type: ignore
+        target.paste(reduced[pt-top:pb-top, pl-left:pr-left], (pl, pt))
+    return scaled
+
+
+T = TypeVar('T')
+
+
+class Canvas(ABC):
+    "画像を継ぎ足していくキャンバスの共通部分"
+
+    @property
+    @abstractmethod
+    def bbox(self) -> Box:
+        "描画済みの範囲"
+
+    @property
+    def size(self) -> tuple[int, int]:
+        left, top, right, bottom = self.bbox
+        return (right - left, bottom - top)
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def query_bbox(self, region:Box) -> Optional[Box]:
+        "region内で描画済みの部分を囲む範囲。何も描画されていなければNone"
+        return intersect_box(self.bbox, region)
+
+    def painted_mask(self, region:Box) -> np.ndarray:
+        "regionの範囲で描画済みの画素をTrueにした配列"
+        left, top, right, bottom = region
+        mask = np.zeros((bottom - top, right - left), bool)
+        painted = self.query_bbox(region)
+        if painted is not None:
+            pl, pt, pr, pb = painted
+            mask[pt-top:pb-top, pl-left:pr-left] = True
+        return mask
+
+    @abstractmethod
+    def crop(self, box:Box) -> np.ndarray:
+        "boxの範囲の配列を返す。描画されていない部分は黒"
+
+    @abstractmethod
+    def paste(self, image:Image.Image | np.ndarray, xy:tuple[int, int]) -> Box:
+        "画像を貼り付け、必要ならキャンバスを広げる。貼り付けた範囲を返す"
+
+    def crop_image(self, box:Box) -> Image.Image:
+        "boxの範囲をPILの画像として返す(範囲の分だけコピーする)"
+        return Image.fromarray(np.ascontiguousarray(self.crop(box)))
+
+    def to_image(self) -> Image.Image:
+        return self.crop_image(self.bbox)
+
+    def apply(self, func:Callable[..., T], *args) -> T:
+        """
+        func(キャンバス, *args)を実行して結果を返す。
+        キャンバスを別のプロセスが持っている場合はそのプロセスで実行するので、funcはモジュールの関数、引数はpickleできるものにする
+        """
+        return func(self, *args)
+
+
+def save_canvas(canvas:Canvas, path:str):
+    "キャンバス全体を画像ファイルに書き出す(Canvas.applyに渡す)"
+    canvas.to_image().save(path)
+
+
+class GrowableCanvas(Canvas):
+    """
+    あらかじめ確保したNumPyのバッファに画像を継ぎ足していくキャンバス。
+    バッファが足りなくなったら拡張方向に容量を倍にして確保し直すので、継ぎ足し1回あたりのコピーは追加分だけで済む。
+
+    座標は最初の画像の左上を(0, 0)とする。左・上に拡張した部分の座標は負になり、バッファ上の原点の位置をずらして扱う。
+    """
+    _buffer: np.ndarray
+    _origin: tuple[int, int] # 座標(0, 0)のバッファ上の位置
+    _bbox:   Optional[Box] = None
+    _lock:   threading.RLock # バッファと原点を一緒に差し替える(UIスレッドが読んでいる間に別のスレッドが継ぎ足すため)
+
+    def __init__(self, image:Optional[Image.Image | np.ndarray]=None):
+        self._buffer = np.zeros((0, 0, 3), np.uint8)
+        self._origin = (0, 0)
+        self._lock   = threading.RLock()
+        if image is not None:
+            array = to_array(image)
+            self._buffer = np.array(array, np.uint8)
+            self._bbox   = (0, 0, array.shape[1], array.shape[0])
+
+    @property
+    def bbox(self) -> Box:
+        if self._bbox is None:
+            raise ValueError('キャンバスに何も描画されていません')
+        return self._bbox
+
+    @property
+    def capacity(self) -> tuple[int, int]:
+        "確保済みのバッファの大きさ"
+        return (self._buffer.shape[1], self._buffer.shape[0])
+
+    def view(self) -> np.ndarray:
+        "描画済みの範囲全体のビュー(コピーしない)"
+        return self.crop(self.bbox)
+
+    def query_bbox(self, region:Box) -> Optional[Box]:
+        bbox = self._bbox
+        if bbox is not None:
+            return intersect_box(bbox, region)
+
+    def crop(self, box:Box) -> np.ndarray:
+        "boxの範囲の配列を返す。描画済みの範囲に収まっていればバッファのビュー(コピーしない)、はみ出した部分は黒"
+        left, top, right, bottom = box
+        with self._lock:
+            buffer, (ox, oy) = self._buffer, self._origin
+            inner = self.query_bbox(box)
+            if inner == box:
+                return buffer[top+oy:bottom+oy, left+ox:right+ox]
+
+            out = np.zeros((bottom - top, right - left, 3), np.uint8)
+            if inner is not None:
+                il, it, ir, ib = inner
+                out[it-top:ib-top, il-left:ir-left] = buffer[it+oy:ib+oy, il+ox:ir+ox]
+            return out
+
+    def paste(self, image:Image.Image | np.ndarray, xy:tuple[int, int]) -> Box:
+        array = to_array(image)
+        x, y = xy
+        box = (x, y, x + array.shape[1], y + array.shape[0])
+        with self._lock:
+            bbox = box if self._bbox is None else union_box(self._bbox, box)
+            self._reserve(bbox)
+            ox, oy = self._origin
+            self._buffer[box[1]+oy:box[3]+oy, box[0]+ox:box[2]+ox] = array
+            self._bbox = bbox
+        return box
+
+    def _reserve(self, box:Box):
+        "boxの範囲がバッファに収まるように、足りない方向に容量を倍々で確保し直す"
+        with self._lock:
+            left, top, right, bottom = box
+            ox, oy = self._origin
+            cap_w, cap_h = self.capacity
+
+            lack_left   = max(0, -(left + ox))
+            lack_top    = max(0, -(top  + oy))
+            lack_right  = max(0, right  + ox - cap_w)
+            lack_bottom = max(0, bottom + oy - cap_h)
+            if not (lack_left or lack_top or lack_right or lack_bottom):
+                return
+
+            # 足りない方向にだけ、少なくとも現在の容量と同じだけ広げる
+            grow_left   = lack_left   and max(lack_left,   cap_w)
+            grow_right  = lack_right  and max(lack_right,  cap_w)
+            grow_top    = lack_top    and max(lack_top,    cap_h)
+            grow_bottom = lack_bottom and max(lack_bottom, cap_h)
+
+            buffer = self._allocate((cap_h + grow_top + grow_bottom, cap_w + grow_left + grow_right, 3))
+            origin = (ox + grow_left, oy + grow_top)
+            if self._bbox is not None:
+                bl, bt, br, bb = self._bbox
+                buffer[bt+origin[1]:bb+origin[1], bl+origin[0]:br+origin[0]] = self._buffer[bt+oy:bb+oy, bl+ox:br+ox]
+            self._buffer, self._origin = buffer, origin
+
+    def _allocate(self, shape:tuple[int, int, int]) -> np.ndarray:
+        "0で埋めたバッファを確保する"
+        return np.zeros(shape, np.uint8)
+
+
+class TiledCanvas(Canvas):
+    """
+    固定サイズのタイルを辞書で管理する疎なキャンバス。
+    描画された部分のタイルだけを確保するので、縦横どちらにも広がる長方形でない画像でも、メモリは描画した面積に比例する。
+    座標の原点は自由で、負の座標にも描画できる。
+
+    使われていないタイルはcompress_tileで圧縮(またはファイルに退避)できる。書き込まれたときは展開してメモリに戻し、読み出すだけなら一時的に展開する。
+    """
+    tile_size:   int
+    tiles:       dict[TileKey, np.ndarray]            # 展開済みのタイル
+    _cold:       dict[TileKey, bytes | tuple[int, int]] # 圧縮したタイル、またはファイルに退避したタイルの(位置, 長さ)
+    _painted:    dict[TileKey, Box] # 確保済みのタイル(圧縮したものも含む)ごとの描画済みの範囲
+    _versions:   dict[TileKey, int] # タイルを書き換えた回数
+    _spill_file: Optional[IO[bytes]] = None
+    _spill_free: list[tuple[int, int]] # 退避したタイルを展開して空いた(位置, 長さ)。位置の順に並べ、隣り合うものはつなげる
+    _finalizer:  Optional[weakref.finalize] = None
+    _lock:       threading.RLock
+    _bbox:       Optional[Box] = None
+
+    def __init__(self, image:Optional[Image.Image | np.ndarray]=None, tile_size:int=256):
+        self.tile_size   = tile_size
+        self.tiles       = {}
+        self._cold       = {}
+        self._painted    = {}
+        self._versions   = {}
+        self._spill_free = []
+        self._lock       = threading.RLock()
+        if image is not None:
+            self.paste(image, (0, 0))
+
+    @property
+    def bbox(self) -> Box:
+        if self._bbox is None:
+            raise ValueError('キャンバスに何も描画されていません')
+        return self._bbox
+
+    @property
+    def resident_bytes(self) -> int:
+        "メモリ上にあるタイル(圧縮したものを含む)の大きさの合計"
+        return sum(tile.nbytes for tile in list(self.tiles.values())) + sum(len(data) for data in list(self._cold.values()) if isinstance(data, bytes))
+
+    def empty_like(self) -> 'TiledCanvas':
+        "同じ種類・同じタイルの大きさの空のキャンバス"
+        return TiledCanvas(tile_size=self.tile_size)
+
+    def _allocate_tile(self) -> np.ndarray:
+        "黒で塗りつぶした新しいタイル"
+        return np.zeros((self.tile_size, self.tile_size, 3), np.uint8)
+
+    def tile_box(self, key:TileKey) -> Box:
+        return tile_box(key, self.tile_size)
+
+    def tile_keys(self, box:Box) -> list[TileKey]:
+        "boxと重なるタイルの位置(確保されていないものも含む)"
+        return tile_keys(box, self.tile_size)
+
+    def _allocated_keys(self, box:Box) -> list[TileKey]:
+        "boxと重なる確保済みのタイルの位置"
+        keys = self.tile_keys(box)
+        if len(keys) <= len(self._painted):
+            return [ key for key in keys if key in self._painted ]
+        else:
+            return [ key for key in list(self._painted) if intersect_box(self.tile_box(key), box) is not None ]
+
+    def _load_tile(self, key:TileKey) -> np.ndarray:
+        "確保済みのタイル。圧縮・退避されていれば展開してメモリに戻す(書き込むときに使う)"
+        tile = self.tiles.get(key)
+        if tile is not None:
+            return tile
+        with self._lock:
+            if key in self.tiles:
+                return self.tiles[key]
+            data = self._cold.pop(key)
+            if isinstance(data, tuple):
+                offset, length = data
+                data = self._read_spilled(offset, length)
+                self._free_spilled(offset, length)
+            tile = self._allocate_tile()
+            tile[...] = np.frombuffer(zlib.decompress(data), np.uint8).reshape(tile.shape)
+            self.tiles[key] = tile
+            return tile
+
+    def _read_tile(self, key:TileKey) -> np.ndarray:
+        """
+        確保済みのタイルを読み出す。圧縮・退避されていれば一時的な配列に展開するだけで、メモリには戻さない
+        (表示や保存で読んだだけで、メモリの予算を超えないようにする)
+        """
+        tile = self.tiles.get(key)
+        if tile is not None:
+            return tile
+        with self._lock:
+            if key in self.tiles:
+                return self.tiles[key]
+            data = self._cold[key]
+            if isinstance(data, tuple):
+                data = self._read_spilled(*data)
+        # 展開はロックの外で行う(zlibはGILを解放する)
+        return np.frombuffer(zlib.decompress(data), np.uint8).reshape(self.tile_size, self.tile_size, 3)
+
+    def _read_spilled(self, offset:int, length:int) -> bytes:
+        "ロックを取ってから呼ぶ"
+        assert self._spill_file is not None
+        self._spill_file.seek(offset)
+        return self._spill_file.read(length)
+
+    def compress_tile(self, key:TileKey, spill:bool=False) -> int:
+        """
+        展開済みのタイルを圧縮してメモリから外す(spillを指定した場合は一時ファイルに書き出す)。
+        減ったメモリ上の大きさを返す。圧縮中に書き換えられた場合は何もしない
+        """
+        with self._lock:
+            tile = self.tiles.get(key)
+            if tile is None:
+                return 0
+            version = self._versions[key]
+        data = zlib.compress(tile, 1) # zlibはGILを解放するので、書き換えと並行して圧縮する
+        with self._lock:
+            if self._versions[key] != version or key not in self.tiles:
+                return 0
+            if spill:
+                offset = self._allocate_spilled(len(data))
+                assert self._spill_file is not None
+                self._spill_file.seek(offset)
+                self._spill_file.write(data)
+                self._cold[key] = (offset, len(data))
+                freed = tile.nbytes
+            else:
+                self._cold[key] = data
+                freed = tile.nbytes - len(data)
+            del self.tiles[key]
+            return freed
+
+    def _allocate_spilled(self, length:int) -> int:
+        "一時ファイルにlengthバイトの領域を確保して位置を返す。空いた領域に収まればそこを使い、なければファイルの末尾に足す"
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix='sd-outpainting-spill-')
+            self._finalizer  = weakref.finalize(self, self._spill_file.close)
+        for i, (offset, free) in enumerate(self._spill_free):
+            if free >= length:
+                if free == length:
+                    del self._spill_free[i]
+                else:
+                    self._spill_free[i] = (offset + length, free - length)
+                return offset
+        return self._spill_file.seek(0, 2)
+
+    def _free_spilled(self, offset:int, length:int):
+        "一時ファイルの領域を空きに戻す。末尾の空きはファイルを切り詰めて返す"
+        assert self._spill_file is not None
+        i = bisect.bisect(self._spill_free, (offset, length))
+        if i < len(self._spill_free) and offset + length == self._spill_free[i][0]:
+            length += self._spill_free.pop(i)[1]
+        if i > 0 and sum(self._spill_free[i - 1]) == offset:
+            offset, free = self._spill_free.pop(i - 1)
+            length += free
+            i -= 1
+        if offset + length == self._spill_file.seek(0, 2):
+            self._spill_file.truncate(offset)
+        else:
+            self._spill_free.insert(i, (offset, length))
+
+    def close(self):
+        "退避に使った一時ファイルを閉じる(退避したタイルは読めなくなる)。参照がなくなったときにも自動で閉じる"
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def query_bbox(self, region:Box) -> Optional[Box]:
+        out = None
+        for key in self._allocated_keys(region):
+            painted = intersect_box(self._painted[key], region)
+            if painted is not None:
+                out = painted if out is None else union_box(out, painted)
+        return out
+
+    def painted_mask(self, region:Box) -> np.ndarray:
+        left, top, right, bottom = region
+        mask = np.zeros((bottom - top, right - left), bool)
+        for key in self._allocated_keys(region):
+            painted = intersect_box(self._painted[key], region)
+            if painted is not None:
+                pl, pt, pr, pb = painted
+                mask[pt-top:pb-top, pl-left:pr-left] = True
+        return mask
+
+    def crop(self, box:Box) -> np.ndarray:
+        "boxの範囲の配列を返す。boxがちょうど1枚のタイルならそのタイル自体(コピーしない)"
+        keys = self._allocated_keys(box)
+        if len(keys) == 1 and self.tile_box(keys[0]) == box:
+            return self._read_tile(keys[0])
+
+        left, top, right, bottom = box
+        out = np.zeros((bottom - top, right - left, 3), np.uint8)
+        for key in keys:
+            tile_box = self.tile_box(key)
+            il, it, ir, ib = intersect_box(tile_box, box) # type: ignore
+            out[it-top:ib-top, il-left:ir-left] = self._read_tile(key)[it-tile_box[1]:ib-tile_box[1], il-tile_box[0]:ir-tile_box[0]]
+        return out
+
+    def paste(self, image:Image.Image | np.ndarray, xy:tuple[int, int]) -> Box:
+        array = to_array(image)
+        x, y = xy
+        box = (x, y, x + array.shape[1], y + array.shape[0])
+        for key in self.tile_keys(box):
+            tile_box = self.tile_box(key)
+            il, it, ir, ib = intersect_box(tile_box, box) # type: ignore
+            with self._lock:
+                if key in self._painted:
+                    tile = self._load_tile(key)
+                    self._painted[key] = union_box(self._painted[key], (il, it, ir, ib))
+                else:
+                    tile = self.tiles[key] = self._allocate_tile()
+                    self._painted[key] = (il, it, ir, ib)
+                    self._versions[key] = 0
+                tile[it-tile_box[1]:ib-tile_box[1], il-tile_box[0]:ir-tile_box[0]] = array[it-y:ib-y, il-x:ir-x]
+                self._versions[key] += 1
+        self._bbox = box if self._bbox is None else union_box(self._bbox, box)
+        return box
+
+
+class MemmapTiledCanvas(TiledCanvas):
+    """
+    タイルをディスク上の一時ファイルにメモリマップして持つTiledCanvas。
+    メモリに載っているのは最近読み書きしたタイル(拡張している端の付近)のページだけになり、
+    それ以外はOSがファイルに書き出して解放できるので、物理メモリより大きな画像も扱える。
+    一時ファイルは作成後すぐに削除されるので、キャンバスが不要になれば領域も解放される
+    """
+    directory:   Optional[str]
+    chunk_tiles: int
+    _file:       IO[bytes]
+    _chunks:     list[np.memmap] # それぞれchunk_tiles枚のタイルを持つ
+    _n_used:     int = 0         # 最後のチャンクで使用済みのタイルの数
+
+    def __init__(self, image:Optional[Image.Image | np.ndarray]=None, tile_size:int=256, directory:Optional[str]=None, chunk_tiles:int=64):
+        self.directory   = directory
+        self.chunk_tiles = chunk_tiles
+        self._file       = tempfile.TemporaryFile(prefix='sd-outpainting-canvas-', dir=directory)
+        self._chunks     = []
+        super().__init__(image, tile_size)
+
+    @property
+    def resident_bytes(self) -> int:
+        "タイルはファイルに書き出せるので数えない"
+        return 0
+
+    def empty_like(self) -> 'MemmapTiledCanvas':
+        return MemmapTiledCanvas(tile_size=self.tile_size, directory=self.directory, chunk_tiles=self.chunk_tiles)
+
+    def compress_tile(self, key:TileKey, spill:bool=False) -> int:
+        "タイルはもともとファイル上にあるので何もしない"
+        return 0
+
+    def _allocate_tile(self) -> np.ndarray:
+        if not self._chunks or self._n_used == self.chunk_tiles:
+            # ファイルを伸ばして(疎なファイルなので書き込むまで領域は使わない)次のチャンクをマップする
+            chunk_shape = (self.chunk_tiles, self.tile_size, self.tile_size, 3)
+            chunk_bytes = int(np.prod(chunk_shape))
+            offset = len(self._chunks) * chunk_bytes
+            self._file.truncate(offset + chunk_bytes)
+            self._chunks.append(np.memmap(self._file, np.uint8, 'r+', offset, chunk_shape))
+            self._n_used = 0
+        tile = self._chunks[-1][self._n_used]
+        self._n_used += 1
+        return tile
+
+
+class MipmapPyramid:
+    """
+    キャンバスを1/2ずつ縮小していった画像の列。
+    縮小画像は必要になった段階まで作り、その後はキャンバスの書き換えられた範囲に重なるタイルだけを縮小し直す
+    """
+    canvas:    Canvas
+    tile_size: int
+    levels:    list[TiledCanvas] # levels[i]は1/2**(i+1)の大きさ
+    _lock:     threading.Lock
+
+    def __init__(self, canvas:Canvas, tile_size:int=256):
+        self.canvas    = canvas
+        self.tile_size = tile_size
+        self.levels    = []
+        self._lock     = threading.Lock()
+
+    @property
+    def n_built(self) -> int:
+        "作成済みの段階の数(元のキャンバスを除く)"
+        return len(self.levels)
+
+    @property
+    def max_level(self) -> int:
+        "縮小してもタイル1枚分以上の大きさが残る最も小さい段階"
+        return max(0, (max(self.canvas.size) // self.tile_size).bit_length() - 1)
+
+    def level(self, level:int) -> Canvas:
+        "1/2**levelの大きさの画像。作成済みでなければIndexError"
+        if level == 0:
+            return self.canvas
+        return self.levels[level - 1]
+
+    def build(self, level:int):
+        "levelの段階まで縮小画像を作る(時間がかかるのでUIスレッド以外から呼ぶ)"
+        with self._lock:
+            while self.n_built < level:
+                source = self.level(self.n_built)
+                target = self.canvas.empty_like() if isinstance(self.canvas, TiledCanvas) else TiledCanvas(tile_size=self.tile_size)
+                downsample(source, target, source.bbox, 1, self.tile_size)
+                self.levels.append(target)
+
+    def update(self, box:Box):
+        "元のキャンバスのboxの範囲が書き換えられたときに、作成済みの段階を更新する"
+        with self._lock:
+            for i, target in enumerate(self.levels):
+                box = downsample(self.level(i), target, box, 1, self.tile_size)
+
+
+class DownsampledProxy:
+    """
+    キャンバス全体を1/2**levelに縮小した小さな代理画像。
+    継ぎ足された範囲だけを縮小して反映し、長辺がmax_sizeの2倍を超えたら代理画像自体をさらに半分にするので、
+    キャンバスがどれだけ大きくなっても1回の更新は継ぎ足した分と代理画像の大きさの分しかかからない
+    """
+    canvas:   Canvas
+    max_size: int
+    level:    int
+    image:    GrowableCanvas
+    version:  int = 0 # 更新するたびに増える
+
+    def __init__(self, canvas:Canvas, max_size:int=512):
+        self.canvas   = canvas
+        self.max_size = max_size
+        self.level    = ((max(canvas.size) - 1) // max_size).bit_length()
+        self.image    = GrowableCanvas()
+        downsample(canvas, self.image, canvas.bbox, self.level)
+
+    def update(self, box:Box):
+        "キャンバスのboxの範囲が書き換えられたときに、その部分だけ縮小し直す"
+        downsample(self.canvas, self.image, box, self.level)
+        while max(self.image.size) > self.max_size * 2:
+            image = GrowableCanvas()
+            downsample(self.image, image, self.image.bbox, 1)
+            self.image = image
+            self.level += 1
+        self.version += 1
+
+
+class MemoryBudget:
+    """
+    TiledCanvasのメモリ上のタイル(圧縮したものを含む)の合計をbudget以下に保つ。
+    超えたら別スレッドで、拡張している端から遠いタイルから順に圧縮(spillを指定した場合は一時ファイルに退避)する。
+    圧縮・退避したタイルは、表示や保存で読まれたときは一時的に展開され、書き込まれたときにメモリに戻る
+    """
+    budget:      int # バイト
+    spill:       bool
+    on_enforced: Optional[Callable[[], None]] = None # 圧縮し終わったときに(別スレッドから)呼ばれる
+    _executor:   ThreadPoolExecutor
+    _lock:       threading.Lock
+    _pending:    Optional[Future] = None
+    _next:       Optional[list[tuple[TiledCanvas, Box]]] = None
+
+    LOW_WATERMARK = 0.9 # 超えたときはここまで減らす
+
+    def __init__(self, budget:int, spill:bool=False):
+        self.budget    = budget
+        self.spill     = spill
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='MemoryBudget')
+        self._lock     = threading.Lock()
+
+    @staticmethod
+    def resident_bytes(canvases:list[TiledCanvas]) -> int:
+        return sum(canvas.resident_bytes for canvas in canvases)
+
+    def request(self, targets:list[tuple[TiledCanvas, Box]]):
+        """
+        (キャンバス, 拡張している端の付近の範囲)のリストについて、予算を超えていれば別スレッドで圧縮する。
+        圧縮中に呼ばれた場合は、終わってから最後に指定されたもので改めて確認する
+        """
+        with self._lock:
+            if self._pending is not None:
+                self._next = targets
+            else:
+                self._pending = self._executor.submit(self._enforce, targets)
+
+    def _enforce(self, targets:list[tuple[TiledCanvas, Box]]):
+        try:
+            while True:
+                total = self.resident_bytes([ canvas for canvas, _ in targets ])
+                if total > self.budget:
+                    # 端から遠いタイルから順に圧縮する
+                    candidates = []
+                    for canvas, hot_box in targets:
+                        cx, cy = (hot_box[0] + hot_box[2]) / 2, (hot_box[1] + hot_box[3]) / 2
+                        for key in list(canvas.tiles):
+                            left, top, right, bottom = canvas.tile_box(key)
+                            candidates.append((math.hypot((left + right) / 2 - cx, (top + bottom) / 2 - cy), canvas, key))
+                    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+                    for _, canvas, key in candidates:
+                        if total <= self.budget * self.LOW_WATERMARK:
+                            break
+                        total -= canvas.compress_tile(key, self.spill)
+                if self.on_enforced is not None:
+                    self.on_enforced()
+
+                with self._lock:
+                    targets, self._next = self._next, None # type: ignore
+                    if targets is None:
+                        self._pending = None
+                        return
+        except:
+            # 圧縮や退避に失敗しても(ディスクがいっぱいなど)、次に呼ばれたときに改めて確認できるようにする
+            with self._lock:
+                self._pending = None
+                self._next = None
+            raise
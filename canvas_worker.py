@@ -0,0 +1,172 @@
+"""
+キャンバスを別のプロセス(ワーカー)に持たせ、継ぎ足し・リサンプリング・書き出しをそのプロセスで実行する。
+バッファは共有メモリに置き、GUIのプロセスは同じバッファを読み取り専用でマップして表示するので、
+大きなキャンバスを扱ってもGUIのプロセスのGILを長く取られない
+"""
+import math
+import multiprocessing
+import sys
+import threading
+import weakref
+from collections.abc import Callable
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Optional, TypeVar
+
+import numpy as np
+from PIL import Image
+
+from canvas import Box, GrowableCanvas, to_array
+
+
+T = TypeVar('T')
+
+
+Geometry = tuple[str, tuple[int, int, int], tuple[int, int], Optional[Box]] # (共有メモリの名前, バッファの形, 原点, 描画済みの範囲)
+
+
+def _attach(name:str) -> SharedMemory:
+    """
+    ワーカーが作った共有メモリを開く。削除はワーカーが行う。
+    (3.12まではここでも登録されるが、spawnしたワーカーとresource_trackerを共有しているので、ワーカーが削除すれば登録も消える)
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, track=False)
+    return SharedMemory(name)
+
+
+class SharedGrowableCanvas(GrowableCanvas):
+    "バッファを共有メモリに確保するGrowableCanvas。ワーカーのプロセスが持って書き込む"
+    _memory:      Optional[SharedMemory] = None
+    _next_memory: Optional[SharedMemory] = None # _allocateで確保して、_reserveで差し替える
+
+    def __init__(self, image:Optional[Image.Image | np.ndarray]=None):
+        super().__init__()
+        self._reserve((0, 0, 1, 1)) # 何も描画されていなくても、共有メモリの名前を渡せるようにする
+        if image is not None:
+            self.paste(image, (0, 0))
+
+    @property
+    def geometry(self) -> Geometry:
+        assert self._memory is not None
+        return (self._memory.name, self._buffer.shape, self._origin, self._bbox) # type: ignore
+
+    def _allocate(self, shape:tuple[int, int, int]) -> np.ndarray:
+        # 新しく作った共有メモリは0で埋められている
+        self._next_memory = SharedMemory(create=True, size=max(1, math.prod(shape)))
+        return np.ndarray(shape, np.uint8, self._next_memory.buf)
+
+    def _reserve(self, box:Box):
+        old = self._memory
+        super()._reserve(box)
+        if self._next_memory is not None:
+            self._memory, self._next_memory = self._next_memory, None
+            if old is not None:
+                # GUIのプロセスがマップしている間は、削除しても中身は残る
+                old.close()
+                old.unlink()
+
+    def close(self):
+        if self._memory is not None:
+            self._buffer = np.zeros((0, 0, 3), np.uint8)
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+
+def _paste(canvas:GrowableCanvas, array:np.ndarray, xy:tuple[int, int]) -> Box:
+    return canvas.paste(array, xy)
+
+def _serve(connection:Connection, image:Optional[np.ndarray]):
+    "ワーカーのプロセスの本体。(関数, 引数)を受け取ってキャンバスに実行し、(成功したか, 結果か例外, キャンバスの形)を返す"
+    canvas = SharedGrowableCanvas(image)
+    connection.send(canvas.geometry)
+    try:
+        while (message := connection.recv()) is not None:
+            func, args = message
+            try:
+                result = (True, func(canvas, *args))
+            except Exception as e:
+                result = (False, e)
+            connection.send(result + (canvas.geometry,))
+    except EOFError:
+        pass
+    finally:
+        canvas.close()
+
+def _shutdown(connection:Connection, process:multiprocessing.process.BaseProcess):
+    try:
+        connection.send(None)
+    except (BrokenPipeError, OSError):
+        pass
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+    connection.close()
+
+
+class CanvasWorker(GrowableCanvas):
+    """
+    ワーカーのプロセスが持つキャンバスを、共有メモリを読み取り専用でマップして扱う。
+    読み出し(crop, query_bbox, bbox)はこのプロセスで直接行い、書き込み(paste)とapplyはワーカーに送って実行する。
+    ワーカーが書き込んでいる最中の範囲を読み出すと、書きかけの画素が見えることがある(書き込み後にupdate_imageで再描画する)
+    """
+    _connection: Connection
+    _process:    multiprocessing.process.BaseProcess
+    _memory:     Optional[SharedMemory] = None
+    _retired:    list[SharedMemory] # 古いバッファ。ビューが残っている間は閉じられない
+    _request_lock: threading.Lock # ワーカーへの要求を1つずつ送る
+
+    def __init__(self, image:Optional[Image.Image | np.ndarray]=None):
+        super().__init__()
+        self._retired = []
+        self._request_lock = threading.Lock()
+
+        # wxやスレッドを使っているプロセスをforkしないように、spawnで起動する
+        context = multiprocessing.get_context('spawn')
+        self._connection, child = context.Pipe()
+        self._process = context.Process(target=_serve, args=(child, None if image is None else to_array(image)), daemon=True, name='CanvasWorker')
+        self._process.start()
+        child.close()
+        self._map(self._connection.recv())
+        self._finalizer = weakref.finalize(self, _shutdown, self._connection, self._process)
+
+    def _map(self, geometry:Geometry):
+        name, shape, origin, bbox = geometry
+        with self._lock:
+            if self._memory is None or self._memory.name != name:
+                memory = _attach(name)
+                buffer = np.ndarray(shape, np.uint8, memory.buf)
+                buffer.flags.writeable = False
+                if self._memory is not None:
+                    self._retired.append(self._memory)
+                self._memory, self._buffer = memory, buffer
+            self._origin, self._bbox = origin, bbox
+
+            retired = []
+            for old in self._retired:
+                try:
+                    old.close()
+                except BufferError:
+                    retired.append(old)
+            self._retired = retired
+
+    def apply(self, func:Callable[..., T], *args) -> T:
+        with self._request_lock:
+            self._connection.send((func, args))
+            ok, result, geometry = self._connection.recv()
+            # 次の要求でワーカーが古い共有メモリを削除する前に、返ってきた順にマップする
+            self._map(geometry)
+        if not ok:
+            raise result
+        return result
+
+    def paste(self, image:Image.Image | np.ndarray, xy:tuple[int, int]) -> Box:
+        return self.apply(_paste, to_array(image), xy)
+
+    def close(self):
+        "ワーカーのプロセスを終了する(参照がなくなったときにも自動で終了する)"
+        self._finalizer()
+
+    def __getstate__(self) -> Any:
+        raise TypeError('CanvasWorkerは別のプロセスに渡せません')
@@ -1,14 +1,25 @@
+import argparse
 import asyncio
-from collections.abc import Generator
+from collections import OrderedDict
+from collections.abc import Callable, Generator
 from concurrent.futures import Future
 from contextlib import contextmanager
+from functools import partial
+import json
 import logging
+import os
+from pathlib import Path
+import threading
 from typing import Annotated, Any, Optional, TypeVar
 
-import wx, wx.lib.scrolledpanel
+import numpy as np
+import wx
 from PIL import Image
 
-from stable_diffusion import DEFAULT_OPTIONS, Direction, StableDiffusion, Status
+from canvas import Box, Canvas, DownsampledProxy, MemmapTiledCanvas, MemoryBudget, MipmapPyramid, TileKey, TiledCanvas, intersect_box, save_canvas, scale_box, tile_box, tile_keys
+from canvas_worker import CanvasWorker
+
+from stable_diffusion import DEFAULT_OPTIONS, ENCODING_PROFILES, Direction, StableDiffusion, Status, Timeouts
 
 
 _LOG = logging.getLogger(__name__)
@@ -17,6 +28,39 @@ _LOG = logging.getLogger(__name__)
 IMAGE_SIZE = 512
 
 
+def api_metadata_path() -> Path:
+    "APIから取得したサンプラーなどの一覧を保存しておくファイル"
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'sd-outpainting-gui' / 'api_metadata.json'
+
+def load_api_metadata(base_url:str) -> dict[str, list[str]]:
+    "前回APIから取得した一覧。なければ空"
+    try:
+        with open(api_metadata_path(), encoding='utf-8') as f:
+            return json.load(f).get(base_url, {})
+    except (OSError, ValueError):
+        return {}
+
+def api_metadata_key(stable_diffusion:StableDiffusion) -> str:
+    "一覧を保存するときのキー。バックエンドのURLを空白で区切って並べる(1つならそのURL)"
+    return ' '.join(stable_diffusion.base_urls)
+
+def save_api_metadata(base_url:str, metadata:dict[str, list[str]]):
+    path = api_metadata_path()
+    try:
+        try:
+            with open(path, encoding='utf-8') as f:
+                root = json.load(f)
+        except (OSError, ValueError):
+            root = {}
+        root[base_url] = metadata
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(root, f, ensure_ascii=False, indent=1)
+    except OSError:
+        _LOG.exception('APIの情報を保存できませんでした')
+
+
 SIZER = TypeVar('SIZER', bound=wx.Sizer)
 
 class SizerStack:
@@ -91,14 +135,26 @@ class SDOptions(wx.CollapsiblePane):
         
         self.Bind(wx.EVT_COLLAPSIBLEPANE_CHANGED, lambda _: parent.SendSizeEvent()) # 開閉時に親のレイアウトを再計算させる
 
+    def set_choices(self, metadata:dict[str, list[str]]):
+        "コンボボックスの選択肢を設定する。選択中の値はそのまま残す"
+        for key, kind in (('sampler_name', 'samplers'), ('scheduler', 'schedulers')):
+            if kind in metadata:
+                combo_box: wx.ComboBox = self.controls[key] # type: ignore
+                value = combo_box.Value
+                combo_box.Set(metadata[kind])
+                combo_box.Value = value
+
     async def fill_in_combo_box_choices(self):
-        samplers   = await self.stable_diffusion.get_sampler_or_scheduler_names('samplers')
-        schedulers = await self.stable_diffusion.get_sampler_or_scheduler_names('schedulers')
-        def _do_update():
-            self.controls['sampler_name'].Set(samplers)   # type: ignore
-            self.controls['scheduler'   ].Set(schedulers) # type: ignore
-        wx.CallAfter(_do_update)
-        self.from_dict(DEFAULT_OPTIONS)
+        "APIから選択肢を取得し直して、前回と違っていれば設定して保存する"
+        samplers, schedulers = await asyncio.gather(
+            self.stable_diffusion.get_sampler_or_scheduler_names('samplers'),
+            self.stable_diffusion.get_sampler_or_scheduler_names('schedulers'),
+        )
+        metadata = dict(samplers=samplers, schedulers=schedulers)
+        base_url = api_metadata_key(self.stable_diffusion)
+        if metadata != load_api_metadata(base_url):
+            wx.CallAfter(self.set_choices, metadata)
+            save_api_metadata(base_url, metadata)
 
     def to_dict(self) -> dict[str, Any]:
         out = {}
@@ -113,14 +169,278 @@ class SDOptions(wx.CollapsiblePane):
                 control.Value = value # type: ignore
 
 
+class CanvasView(wx.ScrolledWindow):
+    """
+    キャンバスを表示するスクロールウィンドウ。
+    ウィンドウ自体は画像の大きさにせず仮想サイズだけを設定し、見えている部分のタイルだけをビットマップに変換して描画する。
+    変換したビットマップはタイルごとにキャッシュし、最近描画していないものから捨てる。
+    TiledCanvasの場合はタイルの大きさを揃えるので、タイルの配列からそのままビットマップを作れる。
+
+    縮小表示(1/2**zoom_level)ではMipmapPyramidの縮小画像を等倍で描画する。Ctrl+ホイールで拡大・縮小する
+    """
+    image:            Optional[Canvas] = None
+    pyramid:          Optional[MipmapPyramid] = None
+    zoom_level:       int = 0
+    on_viewport_changed: Optional[Callable[[], None]] = None # 表示している範囲が変わったときに呼ばれる
+    origin:           tuple[int, int] = (0, 0) # 仮想領域の左上に対応する、表示中の段階の座標
+    tile_size:        int
+    max_cached_tiles: int
+    _tile_cache:      OrderedDict[TileKey, wx.Bitmap] # 表示中の段階のタイルだけを持つ
+    _building:        bool = False
+
+    def __init__(self, parent:wx.Window, tile_size:int=256, max_cached_tiles:int=128, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.tile_size = tile_size
+        self.max_cached_tiles = max_cached_tiles
+        self._tile_cache = OrderedDict()
+        self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
+        self.SetScrollRate(16, 16)
+        self.Bind(wx.EVT_PAINT, self._on_paint)
+        self.Bind(wx.EVT_MOUSEWHEEL, self._on_mouse_wheel)
+
+    @property
+    def displayed_image(self) -> Optional[Canvas]:
+        "表示中の段階の画像"
+        if self.pyramid is not None:
+            return self.pyramid.level(self.zoom_level)
+
+    def set_image(self, image:Optional[Canvas]):
+        self.image = image
+        if isinstance(image, TiledCanvas):
+            self.tile_size = image.tile_size
+        self.pyramid = MipmapPyramid(image, self.tile_size) if image is not None else None
+        self.zoom_level = 0
+        self._reset_geometry()
+
+    def _reset_geometry(self):
+        self._tile_cache.clear()
+        image = self.displayed_image
+        if image is not None:
+            self.origin = image.bbox[:2]
+        self.SetVirtualSize(image.size if image is not None else (0, 0))
+        self.Refresh()
+
+    def set_zoom_level(self, level:int, anchor:Optional[wx.Point]=None):
+        """
+        1/2**levelの大きさで表示する。anchor(ウィンドウ内の座標)の位置に表示されている点は動かさない。
+        縮小画像がまだなければ別スレッドで作ってから切り替える
+        """
+        if self.pyramid is None:
+            return
+        level = max(0, min(level, self.pyramid.max_level))
+        if level == self.zoom_level:
+            return
+        if level > self.pyramid.n_built:
+            if not self._building:
+                self._building = True
+                def _build(pyramid:MipmapPyramid):
+                    try:
+                        pyramid.build(level)
+                    finally:
+                        wx.CallAfter(_on_built, pyramid)
+                def _on_built(pyramid:MipmapPyramid):
+                    self._building = False
+                    if pyramid is self.pyramid:
+                        self.set_zoom_level(level, anchor)
+                threading.Thread(target=_build, args=(self.pyramid,), daemon=True, name='Mipmap').start()
+            return
+
+        if anchor is None:
+            size = self.GetClientSize()
+            anchor = wx.Point(size.width // 2, size.height // 2)
+        x, y = self.CalcUnscrolledPosition(anchor.x, anchor.y)
+        # 元のキャンバスの座標
+        x, y = (x + self.origin[0]) << self.zoom_level, (y + self.origin[1]) << self.zoom_level
+        self.zoom_level = level
+        self._reset_geometry()
+        x, y = (x >> level) - self.origin[0] - anchor.x, (y >> level) - self.origin[1] - anchor.y
+        rate_x, rate_y = self.GetScrollPixelsPerUnit()
+        self.Scroll(max(0, x) // rate_x, max(0, y) // rate_y)
+
+    def visible_box(self) -> Optional[Box]:
+        "表示している範囲(元のキャンバスの座標)"
+        if self.image is None:
+            return None
+        x, y = self.CalcUnscrolledPosition(0, 0)
+        width, height = self.GetClientSize()
+        left, top = self.origin
+        return ((x + left) << self.zoom_level, (y + top) << self.zoom_level, (x + left + width) << self.zoom_level, (y + top + height) << self.zoom_level)
+
+    def center_on(self, x:int, y:int):
+        "元のキャンバスの座標(x, y)が中央に来るようにスクロールする"
+        width, height = self.GetClientSize()
+        x, y = (x >> self.zoom_level) - self.origin[0] - width // 2, (y >> self.zoom_level) - self.origin[1] - height // 2
+        rate_x, rate_y = self.GetScrollPixelsPerUnit()
+        self.Scroll(max(0, x) // rate_x, max(0, y) // rate_y)
+
+    def update_image(self, box:Box):
+        """
+        キャンバスのboxの範囲が書き換えられたときに、そこに重なるタイルだけを変換し直して再描画する。
+        縮小画像は呼び出す前にpyramid.updateで更新しておく。
+        タイルはキャンバスの座標で管理しているので、左・上に広がって表示位置がずれた場合も他のタイルは変換し直さなくてよい
+        """
+        image = self.displayed_image
+        assert image is not None
+        box = scale_box(box, self.zoom_level)
+        for key in tile_keys(box, self.tile_size):
+            self._tile_cache.pop(key, None)
+        self.SetVirtualSize(image.size)
+
+        origin = image.bbox[:2]
+        if origin != self.origin:
+            # 表示されている内容全体がずれるので、同じ部分が見えるように同じだけスクロールして、見えている範囲を描画し直す
+            x, y = self.CalcUnscrolledPosition(0, 0)
+            x, y = x + self.origin[0] - origin[0], y + self.origin[1] - origin[1]
+            self.origin = origin
+            rate_x, rate_y = self.GetScrollPixelsPerUnit()
+            self.Scroll(max(0, x) // rate_x, max(0, y) // rate_y)
+            self.Refresh()
+        else:
+            x, y = self.CalcScrolledPosition(box[0] - origin[0], box[1] - origin[1])
+            self.RefreshRect(wx.Rect(x, y, box[2] - box[0], box[3] - box[1]))
+
+    def _get_tile_bitmap(self, image:Canvas, key:TileKey) -> wx.Bitmap:
+        bitmap = self._tile_cache.get(key)
+        if bitmap is not None:
+            self._tile_cache.move_to_end(key)
+            return bitmap
+
+        box = intersect_box(tile_box(key, self.tile_size), image.bbox)
+        assert box is not None
+        # 中間のbytesやwx.Imageを作らずに、配列のバッファから直接ビットマップを作る
+        array = np.ascontiguousarray(image.crop(box))
+        bitmap = wx.Bitmap.FromBuffer(array.shape[1], array.shape[0], array)
+        self._tile_cache[key] = bitmap
+        while len(self._tile_cache) > self.max_cached_tiles:
+            self._tile_cache.popitem(last=False)
+        return bitmap
+
+    def _on_paint(self, _):
+        dc = wx.AutoBufferedPaintDC(self)
+        self.DoPrepareDC(dc)
+        dc.SetBackground(wx.Brush(self.GetBackgroundColour()))
+        dc.Clear()
+        image = self.displayed_image
+        if image is None:
+            return
+
+        # 再描画が必要な範囲を表示中の段階の座標に直す
+        left, top = self.origin
+        update = self.GetUpdateRegion().GetBox()
+        x, y = self.CalcUnscrolledPosition(update.x, update.y)
+        region = intersect_box((x + left, y + top, x + left + update.width, y + top + update.height), image.bbox)
+        if region is None:
+            return
+        for key in tile_keys(region, self.tile_size):
+            box = tile_box(key, self.tile_size)
+            dc.DrawBitmap(self._get_tile_bitmap(image, key), max(box[0], left) - left, max(box[1], top) - top)
+
+        # スクロール・リサイズ・拡大縮小のどれでも描画し直されるので、ここで表示範囲の変化を知らせる
+        if self.on_viewport_changed is not None:
+            self.on_viewport_changed()
+
+    def _on_mouse_wheel(self, e:wx.MouseEvent):
+        if e.ControlDown():
+            self.set_zoom_level(self.zoom_level + (1 if e.GetWheelRotation() < 0 else -1), e.GetPosition())
+        else:
+            e.Skip()
+
+
+class Minimap(wx.Panel):
+    """
+    キャンバス全体と表示している範囲を示す小さな地図。クリック・ドラッグした位置に表示を移動する。
+    キャンバスから直接縮小せず、継ぎ足しのたびに更新するDownsampledProxyを描画する
+    """
+    view:           CanvasView
+    proxy:          Optional[DownsampledProxy] = None
+    _bitmap:        Optional[wx.Bitmap] = None
+    _bitmap_key:    Optional[tuple[int, int, int, int]] = None # (代理画像のversion, 代理画像の段階, 幅, 高さ)
+    _last_viewport: Optional[Box] = None
+
+    def __init__(self, parent:wx.Window, view:CanvasView, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.view = view
+        self.view.on_viewport_changed = self._on_viewport_changed
+        self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
+        self.Bind(wx.EVT_PAINT, self._on_paint)
+        self.Bind(wx.EVT_SIZE, lambda _: self.Refresh())
+        self.Bind(wx.EVT_LEFT_DOWN, self._on_mouse)
+        self.Bind(wx.EVT_MOTION, self._on_mouse)
+
+    def set_image(self, image:Optional[Canvas]):
+        self.proxy = DownsampledProxy(image) if image is not None else None
+        self.Refresh()
+
+    def _layout(self) -> Optional[tuple[float, int, int]]:
+        "(キャンバスからの縮小率, 描画位置x, 描画位置y)"
+        if self.proxy is None:
+            return None
+        width, height = self.GetClientSize()
+        canvas_width, canvas_height = self.proxy.canvas.size
+        scale = min(width / canvas_width, height / canvas_height)
+        return (scale, (width - round(canvas_width * scale)) // 2, (height - round(canvas_height * scale)) // 2)
+
+    def _get_bitmap(self) -> wx.Bitmap:
+        assert self.proxy is not None
+        layout = self._layout()
+        assert layout is not None
+        scale = layout[0]
+        width, height = max(1, round(self.proxy.canvas.width * scale)), max(1, round(self.proxy.canvas.height * scale))
+        key = (self.proxy.version, self.proxy.level, width, height)
+        if self._bitmap is None or key != self._bitmap_key:
+            array = np.ascontiguousarray(self.proxy.image.view())
+            self._bitmap = wx.ImageFromBuffer(array.shape[1], array.shape[0], array).Scale(width, height, wx.IMAGE_QUALITY_BILINEAR).ConvertToBitmap()
+            self._bitmap_key = key
+        return self._bitmap
+
+    def _on_paint(self, _):
+        dc = wx.AutoBufferedPaintDC(self)
+        dc.SetBackground(wx.Brush(self.GetBackgroundColour()))
+        dc.Clear()
+        layout = self._layout()
+        if layout is None:
+            return
+        scale, x, y = layout
+        dc.DrawBitmap(self._get_bitmap(), x, y)
+
+        viewport = self.view.visible_box()
+        if viewport is not None:
+            left, top = self.proxy.canvas.bbox[:2] # type: ignore
+            dc.SetPen(wx.Pen(wx.RED, 1))
+            dc.SetBrush(wx.TRANSPARENT_BRUSH)
+            dc.DrawRectangle(
+                x + round((viewport[0] - left) * scale),
+                y + round((viewport[1] - top)  * scale),
+                max(2, round((viewport[2] - viewport[0]) * scale)),
+                max(2, round((viewport[3] - viewport[1]) * scale)),
+            )
+
+    def _on_viewport_changed(self):
+        viewport = self.view.visible_box()
+        if viewport != self._last_viewport:
+            self._last_viewport = viewport
+            self.Refresh()
+
+    def _on_mouse(self, e:wx.MouseEvent):
+        layout = self._layout()
+        if layout is not None and e.LeftIsDown():
+            scale, x, y = layout
+            left, top = self.proxy.canvas.bbox[:2] # type: ignore
+            self.view.center_on(left + round((e.GetX() - x) / scale), top + round((e.GetY() - y) / scale))
+
+
 class MainFrame(wx.Frame):
-    scrolled_panel: wx.lib.scrolledpanel.ScrolledPanel
-    canvas:         wx.Panel
-    image:          Optional[Image.Image] = None
-    bitmap:         Optional[wx.Bitmap] = None
+    canvas_view: CanvasView
+    minimap:     Minimap
+    image:       Optional[Canvas] = None
 
     direction_buttons:      list[tuple[wx.RadioButton, Direction]]
     gen_width_control:      wx.SpinCtrl
+    native_res_control:     wx.CheckBox
+    bands_control:          wx.CheckBox
+    context_width_control:  wx.SpinCtrl
+    only_masked_control:    wx.CheckBox
+    padding_control:        wx.SpinCtrl
     n_consecutive_control:  wx.SpinCtrl
     generate_cancel_button: wx.Button
     consecutive_gen_button: wx.Button
@@ -132,10 +452,21 @@ class MainFrame(wx.Frame):
     is_horizontal: Optional[bool] = None
 
     stable_diffusion: StableDiffusion
+    canvas_factory:   Callable[[Image.Image], Canvas] # 開いた画像からキャンバスを作る
+    frame_multiple:   int # 生成範囲の幅と高さをこの倍数に切り上げる
+    warm_up:          bool # APIの起動を確認したら、接続を開いてモデルを読み込ませておく
+    _generation_task: Optional[asyncio.Task] = None # 生成中のタスク。中止するときにキャンセルする
+    memory_budget:    Optional[MemoryBudget]
 
-    def __init__(self, stable_diffusion:StableDiffusion):
+    def __init__(self, stable_diffusion:StableDiffusion, canvas_factory:Callable[[Image.Image], Canvas]=TiledCanvas, memory_budget:Optional[MemoryBudget]=None, frame_multiple:int=8, warm_up:bool=False):
         super().__init__(None)
         self.stable_diffusion = stable_diffusion
+        self.warm_up = warm_up
+        self.canvas_factory = canvas_factory
+        self.frame_multiple = frame_multiple
+        self.memory_budget = memory_budget
+        if memory_budget is not None:
+            memory_budget.on_enforced = self._show_memory_usage
         self.direction_buttons = []
     
         root_panel = wx.Panel(self)
@@ -174,6 +505,24 @@ class MainFrame(wx.Frame):
                     self.gen_width_control = wx.SpinCtrl(root_panel, initial=192, min=32, max=IMAGE_SIZE-32)
                     sizers.Add(self.gen_width_control)
                     self.gen_width_control.Increment = 32
+                    sizers.Add(wx.StaticText(root_panel, label='手がかりの幅(px)'))
+                    self.context_width_control = wx.SpinCtrl(root_panel, initial=0, min=0, max=IMAGE_SIZE*2)
+                    self.context_width_control.SetToolTip('生成範囲に含める既存の画像の幅。0なら生成サイズ-生成幅(正方形)。狭くすると生成範囲が小さくなり速い')
+                    sizers.Add(self.context_width_control)
+                    self.context_width_control.Increment = 32
+                    self.only_masked_control = wx.CheckBox(root_panel, label='マスク部分だけ生成')
+                    self.only_masked_control.SetToolTip('Web UIの「Only masked」で、生成する部分と周りの手がかりだけを生成する(速いが、遠くの手がかりは使われない)')
+                    sizers.Add(self.only_masked_control)
+                    self.padding_control = wx.SpinCtrl(root_panel, initial=64, min=0, max=IMAGE_SIZE)
+                    self.padding_control.SetToolTip('マスク部分だけ生成するときに加える手がかりの幅(px)')
+                    sizers.Add(self.padding_control)
+                    self.padding_control.Increment = 32
+                    self.native_res_control = wx.CheckBox(root_panel, label='元の解像度を保つ')
+                    self.native_res_control.SetToolTip('キャンバスをリサイズせず、生成に使う部分だけを生成サイズに拡大・縮小する')
+                    sizers.Add(self.native_res_control)
+                    self.bands_control = wx.CheckBox(root_panel, label='帯に分けて生成')
+                    self.bands_control.SetToolTip('生成方向と垂直な辺が生成サイズより長いときに、縮小せずに重なり合う帯に分けて生成し、重なった部分を混ぜる(帯ごとの生成は別々に行われる)')
+                    sizers.Add(self.bands_control)
 
                 # 「生成」ボタン
                 self.generate_cancel_button = wx.Button(root_panel, label='', size=wx.Size(100, 40))
@@ -211,30 +560,33 @@ class MainFrame(wx.Frame):
             sizers.Add(self.sd_options, 0, border=6, flag=wx.EXPAND)
             _LOG.info(f'デフォルトの生成オプション: {self.sd_options.to_dict()}')
 
-            self.scrolled_panel = wx.lib.scrolledpanel.ScrolledPanel(root_panel, size=wx.Size(IMAGE_SIZE, IMAGE_SIZE))
-            self.canvas = wx.Panel(self.scrolled_panel, size=wx.Size(IMAGE_SIZE, IMAGE_SIZE))
-            self.canvas.Bind(wx.EVT_PAINT, self._do_draw_image)
-            self.canvas.MinSize = self.canvas.Size # type: ignore
-            scr_sizer = wx.BoxSizer()
-            scr_sizer.Add(self.canvas)
-            self.scrolled_panel.SetSizer(scr_sizer)
-            self.scrolled_panel.SetupScrolling()
-            sizers.Add(self.scrolled_panel, 1, border=6, flag=wx.EXPAND)
+            with sizers.sizer(wx.BoxSizer(), proportion=1, flag=wx.EXPAND):
+                self.canvas_view = CanvasView(root_panel, size=wx.Size(IMAGE_SIZE, IMAGE_SIZE))
+                sizers.Add(self.canvas_view, 1, flag=wx.EXPAND)
+                self.minimap = Minimap(root_panel, self.canvas_view, size=wx.Size(160, 160))
+                sizers.Add(self.minimap, 0, flag=wx.EXPAND)
 
         menu_bar = wx.MenuBar()
         file_menu = wx.Menu()
         file_menu.Append(wx.ID_OPEN,   '画像を開く')
         file_menu.Append(wx.ID_SAVEAS, '保存')
         menu_bar.Append(file_menu, 'ファイル')
+        view_menu = wx.Menu()
+        view_menu.Append(wx.ID_ZOOM_IN,  '拡大')
+        view_menu.Append(wx.ID_ZOOM_OUT, '縮小')
+        menu_bar.Append(view_menu, '表示')
         self.SetMenuBar(menu_bar)
         self.Bind(wx.EVT_MENU, self._on_menu)
         acc_table = wx.AcceleratorTable([
-            wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('O'), wx.ID_OPEN  ),
-            wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('S'), wx.ID_SAVEAS)
+            wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('O'), wx.ID_OPEN    ),
+            wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('S'), wx.ID_SAVEAS  ),
+            wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('+'), wx.ID_ZOOM_IN ),
+            wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('-'), wx.ID_ZOOM_OUT)
         ])
         self.SetAcceleratorTable(acc_table)
 
-        self.CreateStatusBar()
+        self.CreateStatusBar(2)
+        self.SetStatusWidths([-1, 200])
     
         frame = self
         class _ImageFileDropTarget(wx.FileDropTarget):
@@ -246,6 +598,9 @@ class MainFrame(wx.Frame):
         self.SetSize(wx.Size(600, 900))
         self.set_status('idle')
 
+        # 前回取得した選択肢をすぐに表示し、APIからの取得は裏で行う
+        self.sd_options.set_choices(load_api_metadata(api_metadata_key(stable_diffusion)))
+        self.sd_options.from_dict(DEFAULT_OPTIONS)
         self.check_api()
 
 
@@ -253,23 +608,29 @@ class MainFrame(wx.Frame):
         "APIが起動していることをチェックし、コンボボックスの選択肢を埋める"
 
         async def _check_api() -> bool:
-            _LOG.info('APIをチェックします...')
-            try:
-                await self.stable_diffusion.get_generation_progress()
-            except:
+            _LOG.info('APIをチェックし、コンボボックスの選択肢を取得します...')
+            # 応答を待つ回数を減らすため、両方を同時にリクエストする
+            backends, choices = await asyncio.gather(self.stable_diffusion.check_backends(), self.sd_options.fill_in_combo_box_choices(), return_exceptions=True)
+            if isinstance(backends, BaseException) or not backends:
                 wx.CallAfter(lambda: self.SetStatusText('APIにアクセスできません'))
-                _LOG.exception('APIにアクセスできません')
+                _LOG.error('APIにアクセスできません', exc_info=backends if isinstance(backends, BaseException) else None)
                 return False
-            _LOG.info('コンボボックスの選択肢を取得し設定します...')
-            _LOG.info('APIをチェックします...')
-            try:
-                await self.sd_options.fill_in_combo_box_choices()
-            except:
+            if isinstance(choices, BaseException):
                 wx.CallAfter(lambda: self.SetStatusText('コンボボックスの選択肢の設定に失敗しました'))
-                _LOG.exception('コンボボックスの選択肢の設定に失敗しました')
+                _LOG.error('コンボボックスの選択肢の設定に失敗しました', exc_info=choices)
                 return False
             _LOG.info('コンボボックスの選択肢を設定しました')
-            wx.CallAfter(lambda: self.SetStatusText('APIの起動を確認しました'))
+            n_backends = len(self.stable_diffusion.backends)
+            wx.CallAfter(lambda: self.SetStatusText('APIの起動を確認しました' + (f' ({len(backends)}/{n_backends})' if n_backends > 1 else ''))) # type: ignore
+            if self.warm_up:
+                self.warm_up = False
+                wx.CallAfter(lambda: self.SetStatusText('ウォームアップしています...'))
+                try:
+                    seconds = await self.stable_diffusion.warm_up()
+                    wx.CallAfter(lambda: self.SetStatusText(f'ウォームアップしました ({seconds:.1f}秒)'))
+                except:
+                    _LOG.exception('ウォームアップに失敗しました')
+                    wx.CallAfter(lambda: self.SetStatusText('ウォームアップに失敗しました'))
             return True
 
         self.check_api_button.Disable()
@@ -278,34 +639,29 @@ class MainFrame(wx.Frame):
         return future
 
 
-    def set_image(self, image:Optional[Image.Image], snap_dir:Optional[Direction]=None):
-        if image is not self.image or image is None:
-            if image is not None:
-                self.image = image
-                self.bitmap = wx.ImageFromBuffer(image.width, image.height, image.tobytes()).ConvertToBitmap()
-                self.canvas.Size = image.size # type: ignore
-                self.canvas.MinSize = self.canvas.Size # type: ignore
-                self.scrolled_panel.SetupScrolling()
-                match snap_dir:
-                    case Direction.RIGHT:
-                        #print(image.width - self.scrolled_panel.Size[0]) # type: ignore
-                        wx.CallAfter(lambda: self.scrolled_panel.Scroll(0x7FFFFFFF, 0))
-                    case Direction.DOWN:
-                        wx.CallAfter(lambda: self.scrolled_panel.Scroll(0, 0x7FFFFFFF))
-            else:
-                self.image = None
-                self.bitmap = None
-            self.generate_cancel_button.Enabled = image is not None
-            self.set_status()
-            self.Refresh()
-
-
-
-    def _do_draw_image(self, *_):
-        if self.bitmap is not None:
-            with wx.PaintDC(self.canvas) as _dc:
-                dc: wx.PaintDC = _dc
-                dc.DrawBitmap(self.bitmap, 0, 0)
+    def set_image(self, image:Optional[Canvas], snap_dir:Optional[Direction]=None):
+        "画像を表示する。キャンバスはその場で書き換えられるので、同じキャンバスでも表示を更新する"
+        self.image = image
+        self.canvas_view.set_image(image)
+        self.minimap.set_image(image)
+        match snap_dir:
+            case Direction.RIGHT:
+                wx.CallAfter(lambda: self.canvas_view.Scroll(0x7FFFFFFF, 0))
+            case Direction.DOWN:
+                wx.CallAfter(lambda: self.canvas_view.Scroll(0, 0x7FFFFFFF))
+        self.generate_cancel_button.Enabled = image is not None
+        self.set_status()
+        self._show_memory_usage()
+
+    def update_image(self, box:Box, snap_dir:Optional[Direction]=None):
+        "表示中のキャンバスのboxの範囲が書き換えられたときに、その部分だけ表示を更新する"
+        self.canvas_view.update_image(box)
+        self.minimap.Refresh()
+        match snap_dir:
+            case Direction.RIGHT:
+                self.canvas_view.Scroll(0x7FFFFFFF, self.canvas_view.GetViewStart()[1])
+            case Direction.DOWN:
+                self.canvas_view.Scroll(self.canvas_view.GetViewStart()[0], 0x7FFFFFFF)
 
     @property
     def selected_direction(self) -> Direction:
@@ -355,12 +711,16 @@ class MainFrame(wx.Frame):
                     try:
                         path = wx.FileSelector('画像を保存', default_extension='png', wildcard='PNG (*.png)|*.png')
                         if path:
-                            self.image.save(path)
+                            self.image.apply(save_canvas, path)
                     except:
                         _LOG.exception('画像の保存に失敗しました')
                         wx.MessageDialog(self, '画像の保存に失敗しました', style=wx.ICON_ERROR).ShowModal()
                 else:
                     wx.MessageDialog(self, '保存できる画像がありません', style=wx.ICON_WARNING).ShowModal()
+            case wx.ID_ZOOM_IN:
+                self.canvas_view.set_zoom_level(self.canvas_view.zoom_level - 1)
+            case wx.ID_ZOOM_OUT:
+                self.canvas_view.set_zoom_level(self.canvas_view.zoom_level + 1)
 
     def _restrict_direction_buttons(self):
         for radiobutton, dir in self.direction_buttons:
@@ -369,20 +729,35 @@ class MainFrame(wx.Frame):
     async def _generate_coroutine(self, n_consecutive:Optional[int]=None):
         try:
             if self.status == 'idle':
+                self._generation_task = asyncio.current_task()
+                n_avoided = self.stable_diffusion.n_model_switches_avoided # 今回の生成で回避した回数を表示するため
+                stitched_before = self.stable_diffusion.last_stitched
+
+                async def show(box:Box):
+                    await self.stable_diffusion.run_in_worker(self._update_display_proxies, box)
+                    wx.CallAfter(self.update_image, box, direction)
+
                 try:
-                    assert self.image
+                    assert self.image is not None
 
                     direction = self.selected_direction
+                    native_resolution = self.native_res_control.GetValue()
+                    expand_kwargs = dict(resample=native_resolution, context_width=self.context_width_control.GetValue() or None, multiple=self.frame_multiple)
+                    generate_kwargs = self.sd_options.to_dict() | dict(only_masked=self.only_masked_control.GetValue(), only_masked_padding=self.padding_control.GetValue())
 
                     # 生成方向と垂直方向の大きさをあらかじめ設定してある大きさにリサイズする
-                    if direction.is_horizontal:
-                        if self.image.height != IMAGE_SIZE:
+                    # (帯に分けて生成する場合は、大きければ縮小しない。元の解像度を保つ場合は生成に使う部分だけをリサイズする)
+                    needs_resize = (lambda length: length < IMAGE_SIZE) if self.bands_control.GetValue() else (lambda length: length != IMAGE_SIZE)
+                    if native_resolution:
+                        pass
+                    elif direction.is_horizontal:
+                        if needs_resize(self.image.height):
                             new_size = (round(self.image.width / self.image.height * IMAGE_SIZE), IMAGE_SIZE)
-                            self.set_image(self.image.resize(new_size), direction)
+                            self.set_image(self.canvas_factory(self.image.to_image().resize(new_size)), direction)
                     else:
-                        if self.image.width != IMAGE_SIZE:
+                        if needs_resize(self.image.width):
                             new_size = (IMAGE_SIZE, round(self.image.height / self.image.width * IMAGE_SIZE))
-                            self.set_image(self.image.resize(new_size), direction)
+                            self.set_image(self.canvas_factory(self.image.to_image().resize(new_size)), direction)
                     #self.is_horizontal = direction.is_horizontal
                     #wx.CallAfter(self._restrict_direction_buttons)
 
@@ -395,45 +770,152 @@ class MainFrame(wx.Frame):
                             await asyncio.sleep(0.5)
                     asyncio.create_task(update_progress_bar())
 
+                    # キャンバスはその場で継ぎ足される
+                    # (継ぎ足した後に中止されても表示は更新するように、showはキャンセルさせない)
+                    result = self.image
                     if n_consecutive is None:
                         # 1回生成
-                        result = await self.stable_diffusion.expand_generatively(self.image, self.gen_width_control.GetValue(), direction, IMAGE_SIZE, self.sd_options.to_dict())
+                        box = await self.stable_diffusion.expand_generatively(result, self.gen_width_control.GetValue(), direction, IMAGE_SIZE, generate_kwargs, **expand_kwargs)
+                        if box is not None:
+                            await asyncio.shield(show(box))
                     else:
                         # 連続生成
-                        result = self.image
                         for iteration in range(n_consecutive):
                             self.set_status(None, f'生成中 ({(iteration + 1)}/{n_consecutive})')
-                            result = await self.stable_diffusion.expand_generatively(result, self.gen_width_control.GetValue(), direction, IMAGE_SIZE, self.sd_options.to_dict())
-                            if self.status == 'cancelling':
+                            box = await self.stable_diffusion.expand_generatively(result, self.gen_width_control.GetValue(), direction, IMAGE_SIZE, generate_kwargs, **expand_kwargs)
+                            if box is not None:
+                                await asyncio.shield(show(box))
+                            if box is None or self.status == 'cancelling':
                                 break
-                            wx.CallAfter(lambda: self.set_image(result, direction))
 
                     if self.status != 'cancelling':
-                        wx.CallAfter(lambda: self.set_image(result, direction))
-                        self.set_status('idle', '生成が完了しました')
+                        usage = self.stable_diffusion.last_pixel_usage
+                        avoided = self.stable_diffusion.n_model_switches_avoided - n_avoided
+                        self.set_status('idle', '生成が完了しました' + (f' ({usage})' if usage is not None else '') + (f' (モデルの読み込み直しを{avoided}回回避)' if avoided else ''))
                     else:
                         self.set_status('idle', '生成を中断しました')
+                except asyncio.CancelledError:
+                    self.set_status('idle', '生成を中断しました')
+                    # 継ぎ足しの途中でキャンセルされた場合は、継ぎ足し終わった部分の表示を更新する
+                    stitched = self.stable_diffusion.last_stitched
+                    if stitched is not None and stitched is not stitched_before:
+                        asyncio.ensure_future(show(stitched))
+                    raise
                 except:
                     self.set_status('idle', '生成がエラーで停止しました')
                     raise
+                finally:
+                    self._generation_task = None
             else:
+                # 待っているリクエストもキャンセルして、残りのステップや継ぎ足しを待たずに止める
                 self.set_status('cancelling', '中断しています...')
-                await self.stable_diffusion.interrupt_generation()
+                task = self._generation_task
+                if task is not None:
+                    seconds = await self.stable_diffusion.cancel_generation(task)
+                    self.set_status(None, f'生成を中断しました ({seconds * 1000:.0f} ms)')
+                else:
+                    await self.stable_diffusion.interrupt_generation()
+        except asyncio.CancelledError:
+            raise
         except:
             _LOG.exception('生成中にエラーが発生しました')
 
+    def _update_display_proxies(self, box:Box):
+        "表示用の縮小画像のうち書き換えられた範囲を、UIスレッドやイベントループのスレッドの外で更新する"
+        pyramid = self.canvas_view.pyramid
+        if pyramid is not None and pyramid.canvas is self.image:
+            pyramid.update(box)
+        proxy = self.minimap.proxy
+        if proxy is not None and proxy.canvas is self.image:
+            proxy.update(box)
+        if self.memory_budget is not None:
+            # 拡張している端に近い部分は残し、遠い部分から圧縮する
+            self.memory_budget.request([ (canvas, scale_box(box, level)) for level, canvas in enumerate(self._tiled_canvases()) ])
+        self._show_memory_usage()
+
+    def _tiled_canvases(self) -> list[TiledCanvas]:
+        "メモリの予算の対象になるキャンバス(元のキャンバスと、作成済みの縮小画像)"
+        pyramid = self.canvas_view.pyramid
+        if pyramid is None or not isinstance(pyramid.canvas, TiledCanvas) or pyramid.canvas is not self.image:
+            return []
+        return [pyramid.canvas, *pyramid.levels]
+
+    def _show_memory_usage(self):
+        """
+        ステータスバーにキャンバスのタイル(縮小画像を含む)がメモリ上で使っている大きさと予算を表示する(どのスレッドから呼んでもよい)。
+        プロセス全体の使用量(表示用のビットマップなどを含む)ではない
+        """
+        used = MemoryBudget.resident_bytes(self._tiled_canvases()) / 2**20
+        if self.memory_budget is not None:
+            text = f'キャンバスのタイル: {used:.0f} / {self.memory_budget.budget / 2**20:.0f} MiB'
+        else:
+            text = f'キャンバスのタイル: {used:.0f} MiB'
+        wx.CallAfter(lambda: self.SetStatusText(text, 1))
+
     def open_image_file(self, path:str):
         img:Image.Image = Image.open(path)
-        self.set_image(img)
+        self.set_image(self.canvas_factory(img))
         self.is_horizontal = None
 
 
+def parse_api(value:str) -> tuple[str, int]:
+    "--apiの値(URL[,N])を(URL, 同時に依頼する生成の数)にする"
+    url, comma, n = value.rpartition(',')
+    return (url, int(n)) if comma else (value, 1)
+
 def main():
-    stable_diffusion = StableDiffusion()
+    parser = argparse.ArgumentParser(description='Stable Diffusion Web UI APIで画像を上下左右に無限に拡張する')
+    parser.add_argument('--canvas', choices=['memory', 'disk', 'process'], default='memory', help='キャンバスをメモリに置くか、ディスク上の一時ファイルにメモリマップするか、別のプロセスの共有メモリに置くか')
+    parser.add_argument('--canvas-dir', help='--canvas diskの一時ファイルを置くディレクトリ(省略時はシステムの一時ディレクトリ)')
+    parser.add_argument('--memory-budget', type=int, metavar='MiB', help='キャンバスがメモリ上で使ってよい大きさ。超えたら拡張している端から遠い部分を圧縮する')
+    parser.add_argument('--spill', action='store_true', help='--memory-budgetを超えたときに、圧縮した部分を一時ファイルに退避する')
+    parser.add_argument('--api', action='append', type=parse_api, metavar='URL[,N]', help='Stable Diffusion Web UI APIのURL。複数指定すると空いているAPIに生成を振り分ける。Nは同時に依頼する生成の数(省略時は1)')
+    parser.add_argument('--health-check-interval', type=float, default=30.0, metavar='SECONDS', help='使えなくなったAPIを調べ直す間隔')
+    parser.add_argument('--no-eta-routing', action='store_true', help='APIの進行状況と最近の生成時間から最も早く終わりそうなAPIを選ばずに、空いているAPIに振り分ける')
+    parser.add_argument('--routing-log', metavar='PATH', help='振り分けの理由(1行に1つのJSON)を書き出すファイル')
+    parser.add_argument('--no-model-affinity', action='store_true', help='override_settingsで指定したモデルを読み込んでいるAPIを優先しない')
+    parser.add_argument('--model-switch-seconds', type=float, default=30.0, metavar='SECONDS', help='APIがモデルを読み込み直すのにかかる時間の見積もり')
+    parser.add_argument('--keep-model-loaded', action='store_true', help='モデルを指定した生成の後に、APIに元のモデルを読み込み直させない')
+    parser.add_argument('--hedge-percentile', type=float, default=0.95, metavar='Q', help='生成を始めてから、最近の生成時間のこの分位(0-1)を過ぎても終わらなければ、空いている別のAPIにも同じ生成を依頼する(0ならしない)')
+    parser.add_argument('--encoding', choices=list(ENCODING_PROFILES), default='default', help='APIに送る画像とマスクのエンコード方法(benchmarks/encoding.pyで比較できる)')
+    parser.add_argument('--frame-multiple', type=int, choices=[8, 64], default=8, help='生成範囲の幅と高さをこの倍数に切り上げる(モデルが要求する倍数)')
+    parser.add_argument('--compress-requests', choices=['auto', 'on', 'off'], default='auto', help='生成リクエストをgzipで圧縮して送るか(autoならAPIが受け付けるか調べる)')
+    parser.add_argument('--no-compress-responses', action='store_true', help='レスポンスの圧縮を求めない')
+    parser.add_argument('--max-connections', type=int, default=8, help='APIへの接続の最大数')
+    parser.add_argument('--keepalive', type=float, default=60.0, metavar='SECONDS', help='使っていない接続を保つ秒数')
+    parser.add_argument('--http2', action='store_true', help='HTTP/2を使う(h2パッケージが必要)')
+    parser.add_argument('--connect-timeout', type=float, default=Timeouts().connect, metavar='SECONDS')
+    parser.add_argument('--generate-timeout', type=float, default=Timeouts().generate, metavar='SECONDS')
+    parser.add_argument('--progress-timeout', type=float, default=Timeouts().progress, metavar='SECONDS')
+    parser.add_argument('--warm-up', action='store_true', help='起動時に接続を開き、小さな画像を生成してモデルを読み込ませておく')
+    parser.add_argument('--workers', type=int, help='画像のエンコード・デコードや継ぎ足しを行うスレッド数(省略時は自動、0ならHTTPのスレッドで行う)')
+    parser.add_argument('--worker-queue', type=int, default=8, help='画像処理のスレッドに同時に渡す処理の数の上限')
+    args = parser.parse_args()
+
+    match args.canvas:
+        case 'memory':  canvas_factory = TiledCanvas
+        case 'disk':    canvas_factory = partial(MemmapTiledCanvas, directory=args.canvas_dir)
+        case 'process': canvas_factory = CanvasWorker
+
+    if args.routing_log is not None:
+        handler = logging.FileHandler(args.routing_log, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        routing_log = logging.getLogger('stable_diffusion.routing')
+        routing_log.addHandler(handler)
+        routing_log.setLevel(logging.INFO)
+
+    compress_requests = { 'auto': None, 'on': True, 'off': False }[args.compress_requests]
+    stable_diffusion = StableDiffusion([], health_check_interval=args.health_check_interval, route_by_eta=not args.no_eta_routing, model_affinity=not args.no_model_affinity, model_switch_seconds=args.model_switch_seconds, keep_model_loaded=args.keep_model_loaded, hedge_percentile=args.hedge_percentile or None, encoding=args.encoding, max_workers=args.workers, max_queued=args.worker_queue, compress_requests=compress_requests, compress_responses=not args.no_compress_responses,
+                                        timeouts=Timeouts(connect=args.connect_timeout, generate=args.generate_timeout, progress=args.progress_timeout),
+                                        max_connections=args.max_connections, keepalive_expiry=args.keepalive, http2=args.http2)
+    for url, max_concurrency in args.api or [ ('http://127.0.0.1:7860/sdapi/v1/', 1) ]:
+        stable_diffusion.add_backend(url, max_concurrency)
 
     app = wx.App()
 
-    main_frame = MainFrame(stable_diffusion)
+    memory_budget = MemoryBudget(args.memory_budget * 2**20, args.spill) if args.memory_budget is not None else None
+
+    main_frame = MainFrame(stable_diffusion, canvas_factory, memory_budget, args.frame_multiple, args.warm_up)
     main_frame.Show()
 
     app.MainLoop()
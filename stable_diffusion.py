@@ -1,18 +1,36 @@
 import asyncio
-from functools import lru_cache
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable, Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, reduce
+import hashlib
+import json
 import logging
+import math
+import statistics
 import threading
-from typing import Any, Literal, Optional
+from typing import TYPE_CHECKING, Any, Literal, NamedTuple, Optional, TypeVar
 import enum
 import base64
+import binascii
+import gzip
+import time
+import zlib
 from io import BytesIO
 
 import numpy as np
-import httpx
 from PIL import Image
+if TYPE_CHECKING:
+    import httpx # 起動を速くするため、使うときに読み込む
+
+from canvas import Box, Canvas, intersect_box, union_box
 
 
 _LOG = logging.getLogger(__name__)
+_ROUTING_LOG = logging.getLogger(__name__ + '.routing') # 振り分けの理由(1行に1つのJSON)
+_ROUTING_LOG.propagate = False # 生成のたびに書き出すので、ハンドラーを追加して有効にしたときだけ出力する
+
+T = TypeVar('T')
 
 
 class Direction(enum.Enum):
@@ -43,18 +61,261 @@ class Direction(enum.Enum):
 Status = Literal['idle', 'generating', 'cancelling'] # TODO: error
 
 
-def image_to_base64(img:Image.Image) -> str:
+class EncodingProfile(NamedTuple):
+    "生成リクエストで送る画像とマスクのエンコード方法"
+    format:        str            # 画像の形式
+    options:       dict[str, Any] # 画像を保存するときにPIL.Image.saveに渡すオプション
+    optimize_mask: bool           # マスクを最適化した1bitのPNGにする
+
+    @property
+    def key(self) -> Hashable:
+        "キャッシュのキーに使う値"
+        return (self.format, tuple(sorted(self.options.items())), self.optimize_mask)
+
+ENCODING_PROFILES: dict[str, EncodingProfile] = {
+    'default':       EncodingProfile('png', {}, False), # Pillowのデフォルト(compress_level=6)
+    **{ f'png-{level}': EncodingProfile('png', dict(compress_level=level), True) for level in range(10) },
+    'webp-lossless': EncodingProfile('webp', dict(lossless=True, quality=0, method=0), True), # サーバーのPillowがWebPに対応している場合のみ
+}
+
+def image_to_bytes(img:Image.Image, format:str='png', **options) -> memoryview:
     bio = BytesIO()
-    img.save(bio, 'png')
-    return base64.b64encode(bio.getbuffer()).decode('ascii')
+    img.save(bio, format, **options)
+    return bio.getbuffer()
+
+def image_to_base64(img:Image.Image, format:str='png', **options) -> str:
+    return base64.b64encode(image_to_bytes(img, format, **options)).decode('ascii')
+
+def encode_image(img:Image.Image, profile:EncodingProfile) -> memoryview:
+    "画像をprofileの形式でエンコードする(base64にはしない)"
+    return image_to_bytes(img, profile.format, **profile.options)
+
+def encode_mask(mask:Image.Image, profile:EncodingProfile) -> memoryview:
+    "マスクをprofileの形式でエンコードする(base64にはしない)"
+    if profile.optimize_mask:
+        return image_to_bytes(mask.convert('1'), 'png', optimize=True)
+    return image_to_bytes(mask)
+
+class Base64(bytes):
+    "base64でエンコード済みのデータ。stream_jsonはそのまま埋め込む"
+
+def to_base64(data:bytes | memoryview) -> Base64:
+    return Base64(base64.b64encode(data))
 
 def base64_to_image(b64:str) -> Image.Image:
     data = base64.b64decode(b64)
     return Image.open(BytesIO(data), formats=['png'])
 
-@lru_cache(1)
-def generate_mask(mask_width:int, dir:Direction, image_size:int) -> Image.Image:
-    data = np.full((image_size, image_size), True, np.bool_)
+def base64_length(n_bytes:int) -> int:
+    return (n_bytes + 2) // 3 * 4
+
+def stream_json(fields:dict[str, Any], chunk_size:int=3 * 2**16) -> tuple[int, AsyncIterator[bytes]]:
+    """
+    fieldsをJSONにして少しずつ返す。値がbytes類(またはそのリスト)のフィールドは、base64の文字列として埋め込む(Base64はそのまま)。
+    base64の文字列やJSON全体をメモリ上に作らない。(全体の長さ, 本体を返すイテレータ)を返す
+    """
+    assert chunk_size % 3 == 0
+    pieces: list[tuple[bytes | memoryview, bool]] = [] # (データ, base64にするか)
+    for i, (key, value) in enumerate(fields.items()):
+        prefix = (',' if i else '{') + json.dumps(key) + ':'
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            pieces += [ (f'{prefix}"'.encode(), False), (value, not isinstance(value, Base64)), (b'"', False) ]
+        elif isinstance(value, list) and value and all(isinstance(item, (bytes, bytearray, memoryview)) for item in value):
+            pieces.append((f'{prefix}['.encode(), False))
+            for j, item in enumerate(value):
+                pieces += [ (b',"' if j else b'"', False), (item, not isinstance(item, Base64)), (b'"', False) ]
+            pieces.append((b']', False))
+        else:
+            pieces.append(((prefix + json.dumps(value)).encode(), False))
+    pieces.append((b'}' if pieces else b'{}', False))
+    length = sum(base64_length(len(data)) if binary else len(data) for data, binary in pieces)
+
+    async def _chunks() -> AsyncIterator[bytes]:
+        for data, binary in pieces:
+            if binary:
+                view = memoryview(data).cast('B')
+                for offset in range(0, len(view), chunk_size):
+                    yield base64.b64encode(view[offset:offset+chunk_size])
+            else:
+                yield bytes(data)
+    return length, _chunks()
+
+async def gzip_chunks(chunks:AsyncIterator[bytes], level:int=1) -> AsyncIterator[bytes]:
+    "chunksを少しずつgzipで圧縮して返す"
+    compressor = zlib.compressobj(level, wbits=31)
+    async for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
+
+async def read_first_image(response:'httpx.Response', key:str='images') -> Image.Image:
+    """
+    レスポンスのJSONを全部読み込まずに、keyのリストの最初の画像を探し、base64を少しずつデコードしてバッファに書き足す。
+    (Content-Lengthは圧縮後の長さのこともあり、デコード後の大きさの見積もりにならないので、バッファはあらかじめ確保しない)
+    """
+    bio = BytesIO()
+    marker = json.dumps(key).encode()
+    state: Literal['key', 'value', 'data', 'done'] = 'key'
+    head = b''    # keyを探している途中のデータ
+    pending = b'' # 4文字に満たないのでまだデコードしていないbase64
+    async for chunk in response.aiter_bytes():
+        if state == 'key':
+            head += chunk
+            index = head.find(marker)
+            if index < 0:
+                head = head[-len(marker):]
+                continue
+            chunk, head, state = head[index+len(marker):], b'', 'value'
+        if state == 'value':
+            # ":" "[" と空白を飛ばして、文字列の始まりを探す
+            stripped = chunk.lstrip(b' \t\r\n:[')
+            if not stripped:
+                continue
+            if not stripped.startswith(b'"'):
+                raise ValueError(f'レスポンスの{key}に画像がありません')
+            chunk, state = stripped[1:], 'data'
+        if state == 'data':
+            end = chunk.find(b'"')
+            pending += (chunk if end < 0 else chunk[:end]).replace(b'\\', b'') # "\/"とエスケープされている場合がある
+            n_decodable = len(pending) // 4 * 4
+            bio.write(binascii.a2b_base64(pending[:n_decodable]))
+            pending = pending[n_decodable:]
+            if end >= 0:
+                state = 'done'
+        # 'done'の後は接続を使い回せるように、残りを読み捨てる
+    if state != 'done':
+        raise ValueError(f'レスポンスに{key}の画像がありません')
+    bio.seek(0)
+    return Image.open(bio, formats=['png'])
+
+class Transfer(NamedTuple):
+    "1回のリクエストで実際に送受信したバイト数(圧縮されていれば圧縮後)と時間"
+    endpoint: str
+    sent:     int
+    received: int
+    seconds:  float
+    backend:  str = '' # バックエンドのURL
+
+    def __str__(self) -> str:
+        return f'{self.backend}{self.endpoint}: 送信 {self.sent / 1024:.1f} KiB 受信 {self.received / 1024:.1f} KiB {self.seconds * 1000:.0f} ms'
+
+
+class BackendProgress(NamedTuple):
+    "APIの/progressで分かる、バックエンドの状態"
+    progress:     float # 実行中の生成の進行度合い(0-1)
+    eta_relative: float # 実行中の生成が終わるまでの秒数(Web UIの見積もり)
+    job_count:    int   # 実行中のジョブの数
+    polled_at:    float # 取得した時刻(time.monotonic)
+
+    @property
+    def is_running(self) -> bool:
+        return self.job_count > 0 or self.progress > 0
+
+
+ModelRequirement = tuple[Optional[str], Optional[str]] # 生成に必要な(チェックポイント, VAE)。Noneならどれでもよい
+
+def model_name(title:str) -> str:
+    "Web UIのモデルの名前から、末尾のハッシュ(' [abcdef1234]')を除く"
+    return title.split(' [')[0]
+
+def required_model(fields:dict[str, Any]) -> Optional[ModelRequirement]:
+    "生成リクエストのoverride_settingsで指定されたモデル。指定されていなければNone"
+    override = fields.get('override_settings') or {}
+    checkpoint, vae = override.get('sd_model_checkpoint'), override.get('sd_vae')
+    if checkpoint is None and vae is None:
+        return None
+    return (checkpoint, vae)
+
+class LoadedModel(NamedTuple):
+    "バックエンドが読み込んでいるモデル(Web UIのoptionsのsd_model_checkpointとsd_vae)"
+    checkpoint: str
+    vae:        str
+
+    def provides(self, required:ModelRequirement) -> bool:
+        "requiredのモデルで、読み込み直さずに生成できるか"
+        checkpoint, vae = required
+        return (checkpoint is None or model_name(checkpoint) == model_name(self.checkpoint)) and (vae is None or model_name(vae) == model_name(self.vae))
+
+
+class Estimate(NamedTuple):
+    "バックエンドに生成を依頼したときに、終わるまでにかかる秒数の見積もり"
+    running: float # 実行中の生成の残り
+    queued:  float # その後に待っている生成
+    switch:  float # モデルの読み込み直し
+    own:     float # 依頼する生成
+
+    @property
+    def completion(self) -> float:
+        return self.running + self.queued + self.switch + self.own
+
+
+class Timeouts(NamedTuple):
+    "APIへのリクエストの、操作ごとのタイムアウト(秒)"
+    connect:  float = 10.0    # 接続
+    generate: float = 60*30   # 生成(モデルの読み込みを含むことがある)
+    progress: float = 5.0     # 進行状況の取得
+    control:  float = 30.0    # 中止や一覧の取得など、その他の操作
+
+
+class EncodedCache:
+    "エンコード済みのデータをキーごとに保持するLRUキャッシュ。ワーカーのスレッドから同時に使ってよい"
+    max_entries: int
+    hits:        int = 0
+    misses:      int = 0
+
+    _entries: OrderedDict[Hashable, Base64]
+    _lock:    threading.Lock
+
+    def __init__(self, max_entries:int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'EncodedCache(entries={len(self._entries)}/{self.max_entries}, hits={self.hits}, misses={self.misses})'
+
+    def get(self, key:Hashable, encode:Callable[[], Base64]) -> Base64:
+        "keyのデータを返す。なければencode()の結果を保存して返す"
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = encode()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class PixelUsage(NamedTuple):
+    "1回の拡張で生成した画素のうち、継ぎ足した画素の数"
+    useful:    int
+    generated: int
+
+    @property
+    def wasted(self) -> int:
+        return self.generated - self.useful
+
+    def __str__(self) -> str:
+        return f'生成 {self.generated:,}px 継ぎ足し {self.useful:,}px 無駄 {self.wasted:,}px ({self.wasted / self.generated:.0%})'
+
+def round_up(value:int, multiple:int) -> int:
+    return -(-value // multiple) * multiple
+
+def frame_size(size:int | tuple[int, int]) -> tuple[int, int]:
+    "生成範囲の大きさ(幅, 高さ)。intなら正方形"
+    return (size, size) if isinstance(size, int) else size
+
+def generate_mask(mask_width:int, dir:Direction, image_size:int | tuple[int, int]) -> Image.Image:
+    width, height = frame_size(image_size)
+    data = np.full((height, width), True, np.bool_)
     match dir:
         case Direction.LEFT:  data[:, -mask_width:] = False
         case Direction.RIGHT: data[:, :mask_width ] = False
@@ -63,9 +324,10 @@ def generate_mask(mask_width:int, dir:Direction, image_size:int) -> Image.Image:
         case invalid: raise ValueError(invalid)
     return Image.fromarray(data)
 
-def pad_image(img:Image.Image, dir:Direction, image_size:int) -> Image.Image:
+def pad_image(img:Image.Image, dir:Direction, image_size:int | tuple[int, int]) -> Image.Image:
     array = np.array(img)
-    out = np.zeros_like(array, shape=(image_size, image_size, 3))
+    width, height = frame_size(image_size)
+    out = np.zeros_like(array, shape=(height, width, 3))
     match dir:
         case Direction.LEFT:  out[:, -array.shape[1]:] = array
         case Direction.RIGHT: out[:, :array.shape[1] ] = array
@@ -74,28 +336,388 @@ def pad_image(img:Image.Image, dir:Direction, image_size:int) -> Image.Image:
         case invalid: raise ValueError(invalid)
     return Image.fromarray(out)
 
-def concat_images(original:Image.Image, generated:Image.Image, generate_width:int, dir:Direction) -> Image.Image:
-    expansion = generate_width
-    output = Image.new(original.mode, (original.width + expansion, original.height) if dir.is_horizontal else (original.width, original.height + expansion))
+def expansion_bands(canvas:Canvas, dir:Direction, image_size:int, overlap:int=64, max_length:Optional[int]=None) -> list[Box]:
+    """
+    キャンバスの拡張方向と垂直な辺を、隣の帯と少なくともoverlapずつ重なる、同じ長さの帯に区切り、それぞれの帯の中で描画済みの範囲を返す。
+    帯の長さはimage_size以上max_length(省略時はimage_sizeの1.25倍)以下で、帯の数が最も少なくなるようにする(少しだけ長い辺を2回に分けて生成しない)。
+    重なった部分は継ぎ足すときに混ぜる。何も描画されていない帯は含まない
+    """
+    if max_length is None:
+        max_length = image_size + image_size // 4
+    left, top, right, bottom = canvas.bbox
+    start, end = (top, bottom) if dir.is_horizontal else (left, right)
+    total = end - start
+    n = max(1, math.ceil((total - overlap) / (max_length - overlap)))
+    length = min(total, max(image_size, -(-(total + (n - 1) * overlap) // n))) # image_sizeより短い帯にはしない
+    offsets = [ start + round(i * (total - length) / (n - 1)) if n > 1 else start for i in range(n) ]
+    bands = []
+    for offset in offsets:
+        region = (left, offset, right, offset + length) if dir.is_horizontal else (offset, top, offset + length, bottom)
+        painted = canvas.query_bbox(region)
+        if painted is not None:
+            # 拡張方向の範囲は描画済みの部分に、垂直方向の範囲は帯に合わせる
+            bands.append((painted[0], region[1], painted[2], region[3]) if dir.is_horizontal else (region[0], painted[1], region[2], painted[3]))
+    return bands
+
+def context_box(band:Box, generate_width:int, dir:Direction, image_size:int) -> Box:
+    "帯の端から生成の手がかりとして切り出す範囲"
+    left, top, right, bottom = band
     match dir:
-        case Direction.LEFT:  positions = ((generate_width, 0), (0, 0))
-        case Direction.RIGHT: positions = ((0, 0), (original.width + generate_width - generated.width, 0))
-        case Direction.UP:    positions = ((0, generate_width), (0, 0))
-        case Direction.DOWN:  positions = ((0, 0), (0, original.height + generate_width - generated.height))
-    output.paste(original, positions[0])
-    output.paste(generated, positions[1])
-    return output
+        case Direction.LEFT:  return (left, top, left+image_size-generate_width, bottom)
+        case Direction.RIGHT: return (right-image_size+generate_width, top, right, bottom)
+        case Direction.UP:    return (left, top, right, top+image_size-generate_width)
+        case Direction.DOWN:  return (left, bottom-image_size+generate_width, right, bottom)
+        case invalid: raise ValueError(invalid)
+
+def concat_images(canvas:Canvas, generated:Image.Image, generate_width:int, dir:Direction, band:Optional[Box]=None, blend:Optional[Box]=None) -> Box:
+    """
+    生成された画像をキャンバス(bandを指定した場合はその帯)の端に継ぎ足す。拡張後の範囲からはみ出す部分は捨てる。書き換えた範囲を返す。
+    blend(直前に継ぎ足した範囲)と重なる部分は、帯の並ぶ方向に向かって既存の画素から徐々に切り替える
+    """
+    left, top, right, bottom = canvas.bbox if band is None else band
+    match dir:
+        case Direction.LEFT:  position, left   = (left - generate_width, top), left - generate_width
+        case Direction.RIGHT: position, right  = (right + generate_width - generated.width, top), right + generate_width
+        case Direction.UP:    position, top    = (left, top - generate_width), top - generate_width
+        case Direction.DOWN:  position, bottom = (left, bottom + generate_width - generated.height), bottom + generate_width
+        case invalid: raise ValueError(invalid)
+    x, y = position
+    box = intersect_box((x, y, x + generated.width, y + generated.height), (left, top, right, bottom))
+    assert box is not None
+    strip = generated.crop((box[0] - x, box[1] - y, box[2] - x, box[3] - y))
+    overlap = None if blend is None else intersect_box(box, blend)
+    if overlap is not None:
+        ol, ot, or_, ob = overlap
+        array = np.array(strip.convert('RGB'))
+        new = array[ot-box[1]:ob-box[1], ol-box[0]:or_-box[0]].astype(np.float32)
+        old = canvas.crop(overlap).astype(np.float32)
+        if dir.is_horizontal:
+            weight = ((np.arange(ob - ot) + 0.5) / (ob - ot))[:, None, None]
+        else:
+            weight = ((np.arange(or_ - ol) + 0.5) / (or_ - ol))[None, :, None]
+        array[ot-box[1]:ob-box[1], ol-box[0]:or_-box[0]] = np.rint(old + (new - old) * weight).astype(np.uint8)
+        return canvas.paste(array, box[:2])
+    return canvas.paste(strip, box[:2])
+
+def crop_sources(canvas:Canvas, jobs:list[tuple[Box, int, int, tuple[int, int]]], dir:Direction) -> list[Image.Image]:
+    "(切り出す帯, 継ぎ足す幅, 生成範囲の拡張方向の長さ, 手がかりの生成サイズ)ごとに手がかりを切り出し、生成サイズにリサンプリングする(Canvas.applyに渡す)"
+    sources = []
+    for band, expansion, frame, source_size in jobs:
+        source = canvas.crop_image(context_box(band, expansion, dir, frame))
+        if source.size != source_size:
+            source = source.resize(source_size, Image.Resampling.LANCZOS)
+        sources.append(source)
+    return sources
+
+def stitch_outputs(canvas:Canvas, jobs:list[tuple[Box, tuple[int, int], int]], outputs:list[Image.Image], dir:Direction) -> Box:
+    """
+    (帯, キャンバスの解像度での生成範囲の大きさ, 継ぎ足す幅)ごとに生成結果をキャンバスの解像度に戻して継ぎ足す(Canvas.applyに渡す)。
+    帯からはみ出す部分は捨てる。隣の帯と重なる部分は、継ぎ目が出ないように混ぜる
+    """
+    boxes = []
+    for (band, native_size, expansion), output in zip(jobs, outputs):
+        if output.size != native_size:
+            output = output.resize(native_size, Image.Resampling.LANCZOS)
+        boxes.append(concat_images(canvas, output, expansion, dir, band, boxes[-1] if boxes else None))
+    return reduce(union_box, boxes)
+
+
+def percentile(values:Iterable[float], q:float) -> float:
+    "valuesのq分位(0-1。最も近い順位の値)"
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def latency_key(fields:dict[str, Any]) -> Hashable:
+    "生成時間を比べられる生成リクエストをまとめるキー"
+    return (fields.get('width'), fields.get('height'), fields.get('steps'), fields.get('inpaint_full_res', False))
+
+async def gather_or_cancel(awaitables:list[Awaitable[T]]) -> list[T]:
+    "すべて終わるのを待って結果を返す。どれかが失敗したら、残りをキャンセルして終わるまで待ってから例外を投げる"
+    tasks = [ asyncio.ensure_future(awaitable) for awaitable in awaitables ]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        pending = [ task for task in tasks if not task.done() ]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
 
 
 mask_blur = 8
 
+class Backend:
+    """
+    生成を依頼するAPI(Web UIのインスタンス)1つ分の接続と状態。
+    Web UIは生成を1つずつ実行するので、同時に依頼する生成はmax_concurrency(通常は1)までにする
+    """
+    base_url:          str
+    max_concurrency:   int # 同時に依頼する生成の数の上限
+    timeouts:          Timeouts
+    compress_requests: Optional[bool] # リクエストボディをgzipで圧縮するか。Noneなら最初の生成の前にAPIが受け付けるか調べる
+    healthy:           bool  = True # 接続できなくなったらFalseにして、ヘルスチェックに成功するまで生成を依頼しない
+    checked_at:        float = 0.0  # 最後にヘルスチェックした時刻(time.monotonic)
+    n_active:          int   = 0    # 依頼して終わっていない生成の数
+    started_at:        float = 0.0  # 最後に生成を依頼した時刻(time.monotonic)
+    released_at:       float = 0.0  # 最後に依頼した生成が終わった(またはキャンセルした)時刻(time.monotonic)
+    idle_at_start:     bool  = False # 最後に生成を依頼する直前の進行状況で、何も実行していなかったか(分からなければFalse)
+    n_generated:       int   = 0
+    n_failures:        int   = 0    # 生成に失敗した回数
+    progress_state:    Optional[BackendProgress] = None # 最後に取得した進行状況
+    model:             Optional[LoadedModel] = None # 読み込んでいるモデル。まだ調べていなければNone
+    latencies:         dict[Hashable, deque[float]] # latency_key → このバックエンドでの最近の生成時間(秒)
+
+    _client:      Optional['httpx.AsyncClient'] = None
+    _client_args: tuple[tuple, dict[str, Any]]
+    _pool:        dict[str, Any] # 接続プールの設定
+
+    def __init__(self, base_url:str, max_concurrency:int=1, timeouts:Timeouts=Timeouts(), compress_requests:Optional[bool]=None, pool:dict[str, Any]={}, client_args:tuple=(), client_kwargs:dict[str, Any]={}):
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.timeouts = timeouts
+        self.compress_requests = compress_requests
+        self.latencies = {}
+        self._pool = dict(pool)
+        self._client_args = (client_args, client_kwargs)
+
+    def __repr__(self) -> str:
+        return f'Backend({self.base_url!r}, active={self.n_active}/{self.max_concurrency}, healthy={self.healthy})'
+
+    @property
+    def client(self) -> 'httpx.AsyncClient':
+        "HTTPクライアント。起動を速くするため、最初に使うときにhttpxを読み込んで作る"
+        if self._client is None:
+            import httpx
+            client_args, client_kwargs = self._client_args
+            pool = dict(self._pool)
+            http2 = pool.pop('http2', False)
+            if http2:
+                try:
+                    import h2 # type: ignore
+                except ImportError:
+                    _LOG.warning('h2パッケージがないので、HTTP/1.1を使います')
+                    http2 = False
+            self._client = httpx.AsyncClient(*client_args, base_url=self.base_url, limits=httpx.Limits(**pool), http2=http2,
+                                             timeout=self._timeout(self.timeouts.control), **client_kwargs)
+        return self._client
+
+    def _timeout(self, seconds:float) -> 'httpx.Timeout':
+        import httpx
+        return httpx.Timeout(seconds, connect=self.timeouts.connect)
+
+    @property
+    def is_free(self) -> bool:
+        return self.healthy and self.n_active < self.max_concurrency
+
+    async def check_health(self) -> bool:
+        "進行状況を取得できるかで、APIが使えるか調べる"
+        import httpx
+        try:
+            await self.poll_progress()
+            healthy = True
+        except httpx.HTTPError as e:
+            _LOG.warning(f'{self.base_url}にアクセスできません: {e!r}')
+            healthy = False
+        if healthy and not self.healthy:
+            _LOG.info(f'{self.base_url}が使えるようになりました')
+        self.healthy, self.checked_at = healthy, time.monotonic()
+        return healthy
+
+    def mark_unhealthy(self, error:BaseException):
+        _LOG.warning(f'{self.base_url}を使えないものとして扱います: {error!r}')
+        self.healthy, self.checked_at = False, time.monotonic()
+
+    async def img2img(self, fields:dict[str, Any]) -> tuple[Image.Image, Transfer]:
+        "生成を依頼して、(最初の生成結果, 送受信量)を返す。画像はまだ読み込んでいない"
+        if self.compress_requests is None:
+            self.compress_requests = await self.accepts_gzip_requests()
+        # 大きなbase64の文字列を含むJSONを丸ごと作らずに、少しずつ送って少しずつ読む
+        length, body = stream_json(fields)
+        if self.compress_requests:
+            # 圧縮後の長さは分からないので、chunkedで送る
+            body = gzip_chunks(body)
+            headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        else:
+            headers = {'Content-Type': 'application/json', 'Content-Length': str(length)}
+
+        sent = 0
+        async def _count_sent() -> AsyncIterator[bytes]:
+            nonlocal sent
+            async for chunk in body:
+                sent += len(chunk)
+                yield chunk
+
+        started = time.perf_counter()
+        async with self.client.stream('POST', 'img2img', timeout=self._timeout(self.timeouts.generate), content=_count_sent(), headers=headers) as response:
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            image = await read_first_image(response)
+            transfer = Transfer('img2img', sent, response.num_bytes_downloaded, time.perf_counter() - started, self.base_url)
+        self.n_generated += 1
+        return image, transfer
+
+    async def accepts_gzip_requests(self) -> bool:
+        "gzipで圧縮したリクエストボディをAPIが受け付けるか調べる(png-infoに空の画像を送る。受け付けなければJSONとして読めずに422になる)"
+        import httpx
+        try:
+            response = await self.client.post('png-info', content=gzip.compress(json.dumps(dict(image='')).encode()), headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+            accepted = response.is_success
+        except httpx.HTTPError:
+            accepted = False
+        _LOG.info(f'{self.base_url}が圧縮したリクエストを受け付けるか: {accepted}')
+        return accepted
+
+    async def interrupt(self):
+        response = await self.client.post('interrupt')
+        response.raise_for_status()
+
+    async def poll_progress(self) -> BackendProgress:
+        "進行状況を取得して、progress_stateに保存する"
+        response = await self.client.get('progress?skip_current_image=true', timeout=self._timeout(self.timeouts.progress))
+        response.raise_for_status()
+        root = response.json()
+        self.progress_state = BackendProgress(root.get('progress') or 0.0, root.get('eta_relative') or 0.0, (root.get('state') or {}).get('job_count') or 0, time.monotonic())
+        return self.progress_state
+
+    async def get_generation_progress(self) -> Optional[float]:
+        "生成の進行度合い(0-1)を返す。生成中でなければNone"
+        progress = (await self.poll_progress()).progress
+        if progress:
+            return progress
+
+    async def poll_model(self) -> LoadedModel:
+        "読み込んでいるモデルをoptionsで調べて、modelに保存する"
+        response = await self.client.get('options')
+        response.raise_for_status()
+        root = response.json()
+        self.model = LoadedModel(root.get('sd_model_checkpoint') or '', root.get('sd_vae') or '')
+        return self.model
+
+    def is_running_own_job(self) -> bool:
+        """
+        最後に取得した進行状況から、依頼した生成をこのバックエンドが実行しているところだと言えるか。
+        依頼する直前に何も実行しておらず、依頼している生成が1つだけで、依頼した後に取得した進行状況でジョブが1つ実行中の場合だけTrue
+        """
+        state = self.progress_state
+        return self.idle_at_start and self.n_active == 1 and state is not None and state.polled_at >= self.started_at and state.job_count == 1
+
+    def needs_switch(self, required:Optional[ModelRequirement]) -> bool:
+        "requiredのモデルで生成するのに、モデルを読み込み直すことになるか(読み込んでいるモデルが分からなければFalse)"
+        return required is not None and self.model is not None and not self.model.provides(required)
+
+    def record_latency(self, key:Hashable, seconds:float, window:int):
+        self.latencies.setdefault(key, deque(maxlen=window)).append(seconds)
+
+    def typical_latency(self, key:Hashable) -> Optional[float]:
+        "このバックエンドでのkeyの生成時間の中央値。まだ生成していなければNone"
+        latencies = self.latencies.get(key)
+        if latencies:
+            return statistics.median(latencies)
+
+    async def get_sampler_or_scheduler_names(self, kind:Literal['samplers', 'schedulers']) -> list[str]:
+        response = await self.client.get(kind)
+        if response.is_success:
+            root = response.json()
+            return [ item['name'] for item in root ]
+        else:
+            return []
+
+
 class StableDiffusion:
-    client:     httpx.AsyncClient
-    event_loop: asyncio.AbstractEventLoop
+    """
+    1つ以上のAPI(バックエンド)に生成を依頼する。生成のリクエストは空いているバックエンドに振り分け、
+    失敗したら別のバックエンドで生成し直す。1回の拡張の帯は、空いているバックエンドで同時に生成する
+    """
+    backends:     list[Backend]
+    event_loop:   asyncio.AbstractEventLoop
+    encoding:     EncodingProfile
+    workers:      Optional[ThreadPoolExecutor] # 画像のエンコード・デコードや継ぎ足しを実行する。Noneならイベントループのスレッドで実行する
+    max_queued:   int # ワーカーに渡して終わっていない処理の上限
+    n_queued:     int = 0
+    n_interrupts: int = 0 # 中止をリクエストした回数
+    n_failovers:  int = 0 # 別のバックエンドで生成し直した回数
+    n_hedges:     int = 0 # ヘッジした(同じ生成を別のバックエンドにも依頼した)回数
+    n_hedge_wins: int = 0 # ヘッジした方が先に終わった回数
+    n_model_switches:         int = 0 # モデルを読み込み直すバックエンドに依頼した回数
+    n_model_switches_avoided: int = 0 # 読み込み直すことになるバックエンドもあったが、必要なモデルを読み込んでいるバックエンドに依頼した回数
+    last_pixel_usage: Optional[PixelUsage] = None # 最後の拡張で生成した画素の内訳
+    last_stitched:    Optional[Box] = None # 最後の拡張で書き換えた範囲(継ぎ足しの途中でキャンセルされた場合も入る)
+    health_check_interval: float # 使えなくなったバックエンドを調べ直す間隔(秒)
+    hedge_percentile:  Optional[float] # 生成時間がこの分位を過ぎたらヘッジする。Noneならヘッジしない
+    hedge_min_samples: int # ヘッジするのに必要な、同じ設定の生成時間の数
+    latency_window:    int # 設定ごとに覚えておく最近の生成時間の数
+    route_by_eta:      bool  # 生成が最も早く終わりそうなバックエンドに振り分ける。Falseなら空いているうち使用中の生成が少ないもの
+    progress_interval: float # 振り分けに使う進行状況を取得し直す間隔(秒)
+    eta_margin:        float # 埋まっているバックエンドを待つのは、空いているものより見積もりがこの割合以上短い場合だけ
+    model_affinity:       bool  # override_settingsでモデルを指定した生成を、そのモデルを読み込んでいるバックエンドに依頼する
+    model_switch_seconds: float # モデルの読み込み直しにかかる秒数の見積もり
+    keep_model_loaded:    bool  # モデルを指定した生成の後に、元のモデルに戻させない(override_settings_restore_afterwards=False)
+    transfers:         deque[Transfer] # 最近のリクエストの送受信量
+    mask_cache:       EncodedCache # (マスクの幅, 方向, 生成サイズ, ぼかし, エンコード方法) → マスク
+    init_image_cache: EncodedCache # (手がかりの内容, 方向, 生成サイズ, エンコード方法) → 初期画像。同じ手がかりで生成し直すときに使う
+
+    _queue:          asyncio.Semaphore
+    timeouts:        Timeouts
+    _backend_args:   dict[str, Any] # add_backendでBackendに渡す設定
+    _backend_freed:  asyncio.Event # バックエンドが空いたり、使えるようになったりしたらセットする
+    _health_checks:  dict[str, asyncio.Task] # URL → 裏で実行しているヘルスチェック
+    _latencies:      dict[Hashable, deque[float]] # latency_key → 最近の生成時間(秒)
+    _background:     set[asyncio.Future] # ヘッジで負けた依頼を止めるタスク
 
-    def __init__(self, base_url:str='http://127.0.0.1:7860/sdapi/v1/', *client_args, **client_kwargs):
-        self.client = httpx.AsyncClient(base_url=base_url, *client_args, **client_kwargs)
-        self.event_loop = asyncio.get_event_loop()
+    def __init__(self, base_url:str | Sequence[str]='http://127.0.0.1:7860/sdapi/v1/', *client_args, max_concurrency:int=1, health_check_interval:float=30.0,
+                 hedge_percentile:Optional[float]=0.95, hedge_min_samples:int=10, latency_window:int=100, route_by_eta:bool=True, progress_interval:float=0.5, eta_margin:float=0.2,
+                 model_affinity:bool=True, model_switch_seconds:float=30.0, keep_model_loaded:bool=False,
+                 encoding:str='default', max_workers:Optional[int]=None, max_queued:int=8, mask_cache_size:int=32, init_image_cache_size:int=8, compress_requests:Optional[bool]=None, compress_responses:bool=True,
+                 timeouts:Timeouts=Timeouts(), max_connections:int=8, max_keepalive_connections:int=4, keepalive_expiry:float=60.0, http2:bool=False, **client_kwargs):
+        """
+        base_url: APIのURL。複数指定すると、それぞれをバックエンドとして生成を振り分ける(add_backendで後から追加してもよい)
+        max_concurrency: バックエンドごとに同時に依頼する生成の数の上限
+        health_check_interval: 使えなくなったバックエンドを調べ直す間隔(秒)
+        route_by_eta: バックエンドの進行状況(/progressのETAと実行中のジョブ)と最近の生成時間から、生成が最も早く終わりそうなバックエンドに振り分ける。
+                      そのバックエンドが埋まっていれば、空いている遅いバックエンドがあっても待つ
+        model_affinity: override_settingsでチェックポイントやVAEを指定した生成を、optionsで調べてそのモデルを読み込んでいるバックエンドに依頼する。
+                        読み込み直しにかかる時間(model_switch_seconds)を見積もりに加えるので、同じモデルの生成は同じバックエンドに集まる
+        keep_model_loaded: モデルを指定した生成の後に、バックエンドに元のモデルを読み込み直させない(次も同じモデルなら読み込まずに済む。他の人と共有しているバックエンドでは注意)
+        hedge_percentile: 生成を始めてから、同じ設定の最近latency_window回の生成時間のこの分位を過ぎても終わらなければ、別のバックエンドにも依頼する(Noneならしない)
+        max_workers: 画像処理のワーカーのスレッド数(Noneなら自動、0ならワーカーを使わない)
+        max_queued:  ワーカーに同時に渡す処理の数の上限。超えた分はイベントループ側で待つ
+        compress_requests:  生成リクエストのボディをgzipで圧縮するか(Noneならバックエンドごとに自動判定)
+        compress_responses: レスポンスをgzipで圧縮するように求めるか
+        max_connections, max_keepalive_connections, keepalive_expiry: バックエンドごとの接続プールの大きさと、使っていない接続を保つ数・秒数
+        http2: HTTP/2を使う(h2パッケージが必要。なければHTTP/1.1)
+        """
+        self.timeouts = timeouts
+        self.health_check_interval = health_check_interval
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+        self.route_by_eta = route_by_eta
+        self.progress_interval = progress_interval
+        self.eta_margin = eta_margin
+        self.model_affinity = model_affinity
+        self.model_switch_seconds = model_switch_seconds
+        self.keep_model_loaded = keep_model_loaded
+        self._latencies = {}
+        self._background = set()
+        self.transfers = deque(maxlen=256)
+        client_kwargs['headers'] = {'Accept-Encoding': 'gzip' if compress_responses else 'identity'} | client_kwargs.get('headers', {})
+        self._backend_args = dict(timeouts=timeouts, compress_requests=compress_requests, client_args=client_args, client_kwargs=client_kwargs,
+                                  pool=dict(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections, keepalive_expiry=keepalive_expiry, http2=http2))
+        # インスタンスごとに専用のイベントループを作るので、同じプロセスで複数作ってもよい
+        self.event_loop = asyncio.new_event_loop()
+        self._backend_freed = asyncio.Event()
+        self._health_checks = {}
+        self.backends = []
+        for url in ([base_url] if isinstance(base_url, str) else base_url):
+            self.add_backend(url, max_concurrency)
+        self.mask_cache = EncodedCache(mask_cache_size)
+        self.init_image_cache = EncodedCache(init_image_cache_size)
+        self.encoding = ENCODING_PROFILES[encoding]
+        # PillowやzlibはGILを解放するので、スレッドでも進行状況の取得などを止めずに済む
+        self.workers = ThreadPoolExecutor(max_workers, thread_name_prefix='ImageWorker') if max_workers != 0 else None
+        self.max_queued = max_queued
+        self._queue = asyncio.Semaphore(max_queued)
 
         def _async_thread():
             "注意: イベントループ内で発生した例外は表示されない！"
@@ -103,61 +725,483 @@ class StableDiffusion:
             self.event_loop.run_forever()
         event_loop_thread = threading.Thread(target=_async_thread, daemon=True, name='HTTP')
         event_loop_thread.start()
-        asyncio.set_event_loop(self.event_loop)
-
-
-    async def expand_generatively(self, original:Image.Image, generate_width:int, direction:Direction, image_size:int, generate_kwargs:dict[str, Any]) -> Image.Image:
-        "Stable Diffusionによる画像の拡張を実行する"
-        w, h = original.size
-        match direction:
-            case Direction.LEFT:  box = (0, 0, image_size-generate_width, h)
-            case Direction.RIGHT: box = (w-image_size+generate_width, 0, w, h)
-            case Direction.UP:    box = (0, 0, w, image_size-generate_width)
-            case Direction.DOWN:  box = (0, h-image_size+generate_width, w, h)
-            case invalid: raise ValueError(invalid)
-        source = original.crop(box)
-        output = await self._generate(source, direction, image_size=image_size, **generate_kwargs)
-        return concat_images(original, output, generate_width, direction)
-
-
-    async def _generate(self, __img:Image.Image, __dir:Direction, mask_blur:int, image_size:int, **kwargs) -> Image.Image:
-        _LOG.info(f'生成リクエストを送信します 生成サイズ: ({image_size}, {image_size})')
-        response = await self.client.post('img2img', timeout=60*30, json=dict(
+
+    def add_backend(self, base_url:str, max_concurrency:int=1) -> Backend:
+        "生成を依頼するAPIを追加する"
+        backend = Backend(base_url, max_concurrency, **self._backend_args)
+        self.backends.append(backend)
+        # 空くのを待っている生成があれば、追加したバックエンドに回す
+        self.event_loop.call_soon_threadsafe(self._backend_freed.set)
+        return backend
+
+    @property
+    def base_urls(self) -> tuple[str, ...]:
+        return tuple( backend.base_url for backend in self.backends )
+
+    async def run_in_worker(self, func:Callable[..., T], *args, **kwargs) -> T:
+        "CPUを使う処理をワーカーで実行して、終わるまで待つ"
+        if self.workers is None:
+            return func(*args, **kwargs)
+        async with self._queue:
+            self.n_queued += 1
+            try:
+                return await self.event_loop.run_in_executor(self.workers, partial(func, *args, **kwargs))
+            finally:
+                self.n_queued -= 1
+
+
+    async def check_backends(self) -> list[Backend]:
+        "すべてのバックエンドを調べて、使えるものを返す"
+        await asyncio.gather(*[ backend.check_health() for backend in self.backends ])
+        healthy = [ backend for backend in self.backends if backend.healthy ]
+        await self._discover_models(healthy, refresh=True)
+        self._backend_freed.set()
+        return healthy
+
+    async def _discover_models(self, backends:Sequence[Backend], refresh:bool=False):
+        "読み込んでいるモデルが分からないバックエンド(refreshならすべて)のモデルを調べる(調べられなければ分からないまま)"
+        unknown = [ backend for backend in backends if refresh or backend.model is None ]
+        for backend, error in zip(unknown, await asyncio.gather(*[ backend.poll_model() for backend in unknown ], return_exceptions=True)):
+            if isinstance(error, BaseException):
+                _LOG.debug(f'{backend.base_url}のモデルを調べられません: {error!r}')
+
+    def _recheck_backends(self, backends:Sequence[Backend]):
+        "使えなくなってからhealth_check_interval秒以上経ったバックエンドを、裏で調べ直す"
+        now = time.monotonic()
+        for backend in backends:
+            if backend.healthy or backend.base_url in self._health_checks or now - backend.checked_at < self.health_check_interval:
+                continue
+            async def _check(backend:Backend):
+                try:
+                    await backend.check_health()
+                finally:
+                    del self._health_checks[backend.base_url]
+                    self._backend_freed.set()
+            self._health_checks[backend.base_url] = asyncio.create_task(_check(backend))
+
+    async def _acquire_backend(self, candidates:Sequence[Backend], key:Hashable=None, required:Optional[ModelRequirement]=None) -> Backend:
+        """
+        candidatesのうち1つを選んで、使用中にする(_release_backendで戻す)。
+        route_by_etaなら、keyの生成が最も早く終わりそうなバックエンドを選び、それが埋まっていれば空くまで待つ。
+        そうでなければ空いているうち使用中の生成が最も少ないものを選び、すべて埋まっていれば空くまで待つ。
+        model_affinityなら、requiredのモデルを読み込み直すことになるバックエンドは後回しにする。
+        使えるバックエンドが1つもなければ、すべて調べ直してそれでもなければRuntimeError
+        """
+        requested = time.monotonic()
+        affinity = required if self.model_affinity else None
+        while True:
+            self._recheck_backends(candidates)
+            healthy = [ backend for backend in candidates if backend.healthy ]
+            if not healthy:
+                if not any(await asyncio.gather(*[ backend.check_health() for backend in candidates ])):
+                    raise RuntimeError(f'使えるAPIがありません: {", ".join(backend.base_url for backend in candidates)}')
+                continue
+            if required is not None:
+                await self._discover_models(healthy)
+            if (self.route_by_eta or self.hedge_percentile is not None) and len(healthy) > 1:
+                # ヘッジで負けた依頼に中止を送ってよいかを、依頼する直前の進行状況で判断する
+                await self._refresh_progress(healthy)
+            best, estimates = self._choose_backend(healthy, key, affinity)
+            if best is not None and best.is_free:
+                if best.needs_switch(required):
+                    self.n_model_switches += 1
+                elif affinity is not None:
+                    # モデルを考えずに選んでいたら読み込み直すことになった場合だけ、回避したと数える
+                    unaware, _ = self._choose_backend(healthy, key, None)
+                    if unaware is not None and unaware.needs_switch(required):
+                        self.n_model_switches_avoided += 1
+                self._log_route(best, key, required, estimates, time.monotonic() - requested)
+                state = best.progress_state
+                best.idle_at_start = not best.n_active and state is not None and not state.is_running and time.monotonic() - state.polled_at <= self.progress_interval
+                best.n_active += 1
+                best.started_at = time.monotonic()
+                return best
+            self._backend_freed.clear()
+            try:
+                # 使えなくなったバックエンドを調べ直したり、見積もりをやり直したりするために、ときどき起きる
+                await asyncio.wait_for(self._backend_freed.wait(), self.health_check_interval if estimates is None else self.progress_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _choose_backend(self, healthy:Sequence[Backend], key:Hashable, required:Optional[ModelRequirement]) -> tuple[Optional[Backend], Optional[dict[Backend, Estimate]]]:
+        """
+        _acquire_backendで依頼するバックエンドを選ぶ。(選んだバックエンド, ETAでの見積もり)を返す。
+        route_by_etaでなければ空いているものから選び、なければNone(見積もりもNone)
+        """
+        if self.route_by_eta and len(healthy) > 1:
+            estimates = { backend: self._estimate(backend, key, required) for backend in healthy }
+            order = lambda backend: (estimates[backend].completion, backend.n_active / backend.max_concurrency)
+            best = min(healthy, key=order)
+            free = [ backend for backend in healthy if backend.is_free ]
+            # 見積もりの誤差で待たないように、埋まっているバックエンドを待つのは十分に早く終わりそうな場合だけ
+            if free and not estimates[best].completion < estimates[min(free, key=order)].completion * (1 - self.eta_margin):
+                best = min(free, key=order)
+            return best, estimates
+        free = [ backend for backend in healthy if backend.is_free ]
+        best = min(free, key=lambda backend: (backend.needs_switch(required), backend.n_active / backend.max_concurrency)) if free else None
+        return best, None
+
+    async def _refresh_progress(self, backends:Sequence[Backend]):
+        "progress_interval秒より古いか、依頼した生成が終わる前の進行状況を取得し直す(取得できなければ古いまま)"
+        now = time.monotonic()
+        stale = [ backend for backend in backends
+                  if backend.progress_state is None or now - backend.progress_state.polled_at >= self.progress_interval or backend.progress_state.polled_at < backend.released_at ]
+        for backend, error in zip(stale, await asyncio.gather(*[ backend.poll_progress() for backend in stale ], return_exceptions=True)):
+            if isinstance(error, BaseException):
+                _LOG.debug(f'{backend.base_url}の進行状況を取得できません: {error!r}')
+
+    def _estimate(self, backend:Backend, key:Hashable, required:Optional[ModelRequirement]=None) -> Estimate:
+        """
+        backendにkeyの生成を依頼したら、いつ終わるかの見積もり。
+        生成時間はそのバックエンドでの最近の中央値(なければ全体の中央値)、実行中の生成の残りはWeb UIのETA(なければ生成時間から見積もる)。
+        requiredのモデルを読み込んでいなければ、読み込み直す時間(model_switch_seconds)を加える
+        """
+        own = backend.typical_latency(key)
+        if own is None:
+            own = statistics.median(self._latencies[key]) if self._latencies.get(key) else 0.0
+        now = time.monotonic()
+        state = backend.progress_state
+        running = 0.0
+        if state is not None and state.is_running and (not backend.n_active or state.polled_at >= backend.started_at):
+            # 他の人の生成も含めて、Web UIの見積もりを使う
+            running = state.eta_relative if state.eta_relative > 0 else own * (1 - state.progress)
+            running = max(0.0, running - (now - state.polled_at))
+        elif backend.n_active:
+            # 進行状況が依頼する前のものなら、依頼してからの時間で見積もる
+            running = max(0.0, own - (now - backend.started_at))
+        queued = max(0, backend.n_active - 1) * own # 実行中の次に、このバックエンドで待っている生成
+        switch = self.model_switch_seconds if backend.needs_switch(required) else 0.0
+        return Estimate(running, queued, switch, own)
+
+    def _log_route(self, backend:Backend, key:Hashable, required:Optional[ModelRequirement], estimates:Optional[dict[Backend, Estimate]], waited:float):
+        "振り分けの理由を、1行のJSONとしてstable_diffusion.routingのロガーに書き出す(ハンドラーが追加されていなければ何もしない)"
+        if not _ROUTING_LOG.hasHandlers():
+            return
+        record = dict(
+            time=round(time.time(), 3),
+            backend=backend.base_url,
+            policy='eta' if estimates is not None else 'least_loaded',
+            request=key,
+            model=required,
+            model_switch=backend.needs_switch(required),
+            waited=round(waited, 3),
+            candidates=[ dict(backend=other.base_url, active=other.n_active, healthy=other.healthy, loaded=other.model, **{ field: round(value, 3) for field, value in estimate._asdict().items() }, completion=round(estimate.completion, 3))
+                         for other, estimate in (estimates or {}).items() ],
+        )
+        _ROUTING_LOG.info(json.dumps(record, ensure_ascii=False))
+
+    def _release_backend(self, backend:Backend):
+        backend.n_active -= 1
+        backend.released_at = time.monotonic()
+        self._backend_freed.set()
+
+    async def _dispatch(self, fields:dict[str, Any], candidates:Optional[Sequence[Backend]]=None) -> Image.Image:
+        """
+        candidates(省略時はすべて)のうち空いているバックエンドに生成を依頼して、生成結果を返す。
+        生成を始めてから、同じ設定の最近の生成時間のhedge_percentile分位を過ぎても終わらなければ、同じ内容を別のバックエンドにも依頼し(ヘッジ)、
+        先に返ってきた結果を使う。遅かった方には中止をリクエストする
+        """
+        candidates = list(self.backends if candidates is None else candidates)
+        key = latency_key(fields)
+        required = required_model(fields)
+        if required is not None and self.keep_model_loaded:
+            fields = dict(override_settings_restore_afterwards=False) | fields
+        started = self.event_loop.create_future() # 最初の依頼がバックエンドで始まったら、その時刻(time.monotonic)で完了する
+        actives: list[list[Backend]] = [[]]       # 依頼ごとの、生成しているバックエンド
+        tasks = [ asyncio.ensure_future(self._dispatch_to(fields, candidates, actives[0], started)) ]
+        winner: Optional[asyncio.Future] = None
+        first_switched = False
+        try:
+            deadline = self._hedge_deadline(key)
+            if deadline is not None and len(candidates) > 1:
+                # バックエンドが空くのを待っている間は数えない
+                await asyncio.wait([tasks[0], started], return_when=asyncio.FIRST_COMPLETED)
+                if any( backend.needs_switch(required) for backend in actives[0] ):
+                    first_switched = True
+                    deadline += self.model_switch_seconds
+                done, _ = await asyncio.wait(tasks, timeout=deadline)
+                # 空いているバックエンドがなければ、他の生成を遅らせないようにヘッジしない
+                others = [ backend for backend in candidates if backend not in actives[0] and backend.is_free ]
+                if not done and others:
+                    self.n_hedges += 1
+                    _LOG.info(f'{deadline:.1f}秒経っても終わらないので、他のAPIにも同じ生成を依頼します: {", ".join(backend.base_url for backend in actives[0])}')
+                    actives.append([])
+                    tasks.append(asyncio.ensure_future(self._dispatch_to(fields, others, actives[1])))
+
+            pending = set(tasks)
+            while winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next(( task for task in tasks if task in done and task.exception() is None ), None)
+                if winner is None and not pending:
+                    # どの依頼も失敗した
+                    raise tasks[0].exception() # type: ignore
+        finally:
+            for task, active in zip(tasks, actives):
+                if task.done() or task is winner:
+                    continue
+                if winner is None:
+                    task.cancel()
+                else:
+                    self._stop_loser(task, active)
+            if winner is None:
+                await asyncio.wait(tasks)
+
+        image, transfer, switched = winner.result()
+        if winner is not tasks[0]:
+            self.n_hedge_wins += 1
+        if not (switched or first_switched):
+            # ヘッジが勝った場合は、遅かった最初の依頼が始まってからの時間を記録する(速かった方の時間だけを記録すると、ヘッジするまでの時間がどんどん短くなる)
+            seconds = transfer.seconds if winner is tasks[0] else time.monotonic() - started.result()
+            self._latencies.setdefault(key, deque(maxlen=self.latency_window)).append(seconds)
+        self._record_transfer(transfer)
+        await self.run_in_worker(image.load)
+        return image
+
+    async def _dispatch_to(self, fields:dict[str, Any], candidates:Sequence[Backend], active:list[Backend], started:Optional[asyncio.Future]=None) -> tuple[Image.Image, Transfer, bool]:
+        """
+        candidatesのうち空いているバックエンドに生成を依頼して、(生成結果, 送受信量, モデルを読み込み直したか)を返す。生成しているバックエンドはactiveに入れておく。
+        接続できなかったりサーバーのエラー(5xx)が返ってきたりした場合は、まだ試していない別のバックエンドで生成し直す
+        """
+        import httpx
+        key, required = latency_key(fields), required_model(fields)
+        remaining = list(candidates)
+        while True:
+            backend = await self._acquire_backend(remaining, key, required)
+            active.append(backend)
+            if started is not None and not started.done():
+                started.set_result(time.monotonic())
+            switched = backend.needs_switch(required)
+            if switched and not fields.get('override_settings_restore_afterwards', True):
+                # 元に戻さないなら、この後に依頼する生成はこのモデルを読み込んでいるものとして振り分ける
+                checkpoint, vae = required # type: ignore
+                backend.model = LoadedModel(checkpoint or backend.model.checkpoint, vae or backend.model.vae) # type: ignore
+            try:
+                image, transfer = await backend.img2img(fields)
+                if not switched:
+                    # モデルを読み込み直した生成の時間は、見積もりに使わない
+                    backend.record_latency(key, transfer.seconds, self.latency_window)
+                return image, transfer, switched
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500:
+                    raise
+                backend.n_failures += 1
+                backend.model = None # 読み込み直せたか分からないので、調べ直す
+                if isinstance(e, httpx.TransportError):
+                    backend.mark_unhealthy(e)
+                remaining.remove(backend)
+                if not any(other.healthy for other in remaining):
+                    raise
+                self.n_failovers += 1
+                _LOG.warning(f'{backend.base_url}での生成に失敗したので、他のAPIで生成し直します: {e!r}')
+            finally:
+                active.remove(backend)
+                self._release_backend(backend)
+
+    def _hedge_deadline(self, key:Hashable) -> Optional[float]:
+        "ヘッジするまでの秒数。ヘッジしないか、まだ生成時間が十分に集まっていなければNone"
+        latencies = self._latencies.get(key)
+        if self.hedge_percentile is None or latencies is None or len(latencies) < self.hedge_min_samples:
+            return None
+        return percentile(latencies, self.hedge_percentile)
+
+    def _stop_loser(self, task:asyncio.Future, active:list[Backend]):
+        """
+        ヘッジで負けた依頼を止める。次の生成を中止してしまわないように、バックエンドを手放す前に中止をリクエストしてからキャンセルする。
+        /interruptは実行中の生成を誰のものでも止めるので、進行状況で依頼した生成が実行中だと分かるバックエンドにだけ送る
+        (他の人の生成の後ろで待っている場合は、リクエストをキャンセルするだけにする)
+        """
+        async def _stop():
+            try:
+                backends = list(active)
+                await asyncio.gather(*[ backend.poll_progress() for backend in backends ], return_exceptions=True)
+                running = [ backend for backend in backends if backend.is_running_own_job() ]
+                for backend in backends:
+                    if backend not in running:
+                        _LOG.info(f'{backend.base_url}では依頼した生成が実行中か分からないので、中止はリクエストせずにキャンセルします')
+                await asyncio.gather(*[ backend.interrupt() for backend in running ], return_exceptions=True)
+            finally:
+                task.cancel()
+        stopping = asyncio.ensure_future(_stop())
+        self._background.add(stopping)
+        stopping.add_done_callback(self._background.discard)
+
+
+    async def expand_generatively(self, canvas:Canvas, generate_width:int, direction:Direction, image_size:int, generate_kwargs:dict[str, Any], resample:bool=False, context_width:Optional[int]=None, multiple:int=8) -> Optional[Box]:
+        """
+        Stable Diffusionによる画像の拡張を実行し、キャンバスに継ぎ足す。書き換えた範囲を返す。
+        拡張方向と垂直な辺が長い場合は、隣と重なり合う帯(expansion_bands)に分けてそれぞれの端から拡張し、重なった部分は混ぜる。
+        resampleを指定した場合は帯に分けず、辺全体から切り出した手がかりだけを生成サイズに拡大・縮小して生成し、
+        結果をキャンバスの解像度に戻して継ぎ足す(generate_widthは生成サイズでの幅になる)。
+        生成範囲は正方形とは限らない。拡張方向は手がかりの幅(context_width、省略時はimage_size-generate_width)+generate_width、
+        垂直方向は帯の長さ(resampleの場合はimage_size)を、それぞれmultipleの倍数に切り上げる(切り上げた分は手がかりを増やす)。
+        生成中に中止がリクエストされた場合は、途中までの生成結果を捨ててNoneを返す
+        継ぎ足しの途中でキャンセルされた場合は、継ぎ足し終わってからCancelledErrorを送出する(書き換えた範囲はlast_stitchedに入る)
+        """
+        self.last_stitched = None
+        bands = [canvas.bbox] if resample else expansion_bands(canvas, direction, image_size)
+        if context_width is None:
+            context_width = image_size - generate_width
+        along = round_up(context_width + generate_width, multiple)
+
+        sources = [] # (切り出す帯, 継ぎ足す幅, 生成範囲の拡張方向の長さ, 手がかりの生成サイズ) すべてキャンバスの解像度
+        jobs = []    # (帯, キャンバスの解像度での生成範囲の大きさ, 継ぎ足す幅)
+        sizes = []   # 生成サイズ
+        useful = 0
+        for band in bands:
+            length = band[3] - band[1] if direction.is_horizontal else band[2] - band[0]
+            perpendicular = round_up(image_size if resample else length, multiple)
+            scale = length / image_size if resample else 1
+            native_along, native_perpendicular, expansion = round(along * scale), round(perpendicular * scale), round(generate_width * scale)
+            # 切り上げて長くなった分は、帯の先の部分も手がかりにする
+            if direction.is_horizontal:
+                crop_band = (band[0], band[1], band[2], band[1] + native_perpendicular)
+                size, native_size = (along, perpendicular), (native_along, native_perpendicular)
+            else:
+                crop_band = (band[0], band[1], band[0] + native_perpendicular, band[3])
+                size, native_size = (perpendicular, along), (native_perpendicular, native_along)
+            source_size = (along - generate_width, perpendicular) if direction.is_horizontal else (perpendicular, along - generate_width)
+            sources.append((crop_band, expansion, native_along, source_size))
+            jobs.append((band, native_size, expansion))
+            sizes.append(size)
+            useful += generate_width * round(length / scale)
+        self.last_pixel_usage = PixelUsage(useful, sum(width * height for width, height in sizes))
+        _LOG.info(f'生成範囲: {sizes} {self.last_pixel_usage}')
+
+        # 継ぎ足した部分が他の帯の手がかりに混ざらないように、先に全部切り出しておく
+        # (キャンバスを別のプロセスが持っている場合は、切り出しと継ぎ足しはそのプロセスで行う)
+        images = await self.run_in_worker(canvas.apply, crop_sources, sources, direction)
+
+        n_interrupts = self.n_interrupts
+        # 帯ごとの生成は、空いているバックエンドで同時に行う
+        outputs = await gather_or_cancel([ self._generate(image, direction, image_size=size, **generate_kwargs) for image, size in zip(images, sizes) ])
+        if self.n_interrupts != n_interrupts:
+            return None
+
+        # 継ぎ足しを途中で止めるとキャンバスが中途半端になるので、キャンセルされても終わるまで待ってからキャンセルを伝える
+        # (書き換えた範囲はlast_stitchedで分かる)
+        stitching = asyncio.ensure_future(self.run_in_worker(canvas.apply, stitch_outputs, jobs, outputs, direction))
+        try:
+            self.last_stitched = await asyncio.shield(stitching)
+        except asyncio.CancelledError:
+            self.last_stitched = await stitching
+            raise
+        return self.last_stitched
+
+
+    async def _generate(self, __img:Image.Image, __dir:Direction, mask_blur:int, image_size:int | tuple[int, int], only_masked:bool=False, only_masked_padding:int=32, backends:Optional[Sequence[Backend]]=None, **kwargs) -> Image.Image:
+        """
+        __imgを手がかりに、image_size(intなら正方形)の生成範囲の__dir側を生成する。
+        only_maskedを指定した場合は、Web UIの「Only masked」で、マスクの範囲に手がかりをonly_masked_padding(px)だけ加えた部分だけを
+        等倍で生成させる(生成範囲全体を生成するより速い。結果は生成範囲全体の大きさで返ってくる)。
+        backendsを指定した場合は、そのうちのどれかに生成を依頼する
+        """
+        width, height = frame_size(image_size)
+        mask_width = (__img.width if __dir.is_horizontal else __img.height) - mask_blur*2
+        if only_masked:
+            # マスクはぼかすとmask_blurほど広がる。拡大・縮小されないように、切り抜かれる範囲と同じ大きさを指定する
+            along = width if __dir.is_horizontal else height
+            region = min(along, round_up(along - mask_width + mask_blur + only_masked_padding, 8))
+            generation_size = (region, height) if __dir.is_horizontal else (width, region)
+            kwargs = dict(inpaint_full_res=True, inpaint_full_res_padding=only_masked_padding) | kwargs
+        else:
+            generation_size = (width, height)
+        _LOG.info(f'生成リクエストを送信します 生成範囲: ({width}, {height}) 生成サイズ: {generation_size}')
+        profile = self.encoding
+        def _init_image() -> Base64:
+            key = (hashlib.blake2b(__img.tobytes(), digest_size=16).digest(), __img.mode, __img.size, __dir, (width, height), profile.key)
+            return self.init_image_cache.get(key, lambda: to_base64(encode_image(pad_image(__img, __dir, (width, height)), profile)))
+        def _mask() -> Base64:
+            key = (mask_width, __dir, (width, height), mask_blur, profile.key)
+            return self.mask_cache.get(key, lambda: to_base64(encode_mask(generate_mask(mask_width, __dir, (width, height)), profile)))
+        init_image, mask = await asyncio.gather(self.run_in_worker(_init_image), self.run_in_worker(_mask))
+        _LOG.debug(f'初期画像: {self.init_image_cache} マスク: {self.mask_cache}')
+        return await self._dispatch(dict(
             restore_faces=False,
             tiling=False,
             denoising_strength=1,
-            init_images=[image_to_base64(pad_image(__img, __dir, image_size))],
-            mask=image_to_base64(generate_mask((__img.width if __dir.is_horizontal else __img.height) - mask_blur*2, __dir, image_size)),
+            init_images=[init_image],
+            mask=mask,
             inpainting_fill=0,
             mask_blur=mask_blur,
-            width=image_size,
-            height=image_size,
-        ) | kwargs)
-        response.raise_for_status()
+            width=generation_size[0],
+            height=generation_size[1],
+        ) | kwargs, backends)
 
-        return base64_to_image(response.json()['images'][0])
+    def _record_transfer(self, transfer:Transfer):
+        self.transfers.append(transfer)
+        _LOG.info(str(transfer))
 
-    async def interrupt_generation(self):
-        "APIに生成の中止をリクエストする"
-        _LOG.info(f'生成の中止をリクエストします')
-        response = await self.client.post('interrupt')
-        response.raise_for_status()
+    def _busy_backends(self) -> list[Backend]:
+        return [ backend for backend in self.backends if backend.n_active ]
+
+    async def interrupt_generation(self, backends:Optional[Sequence[Backend]]=None):
+        """
+        APIに生成の中止をリクエストする(省略時は生成を依頼しているバックエンド)。
+        /interruptはそのバックエンドで実行中の生成を誰のものでも止めるので、依頼していないバックエンドには送らない
+        """
+        if backends is None:
+            backends = self._busy_backends()
+        if not backends:
+            _LOG.info('生成を依頼しているバックエンドがないので、中止はリクエストしません')
+        else:
+            _LOG.info(f'生成の中止をリクエストします: {", ".join(backend.base_url for backend in backends)}')
+        self.n_interrupts += 1
+        await asyncio.gather(*[ backend.interrupt() for backend in backends ])
+
+    async def cancel_generation(self, task:asyncio.Task) -> float:
+        """
+        生成しているタスクをキャンセルし、APIにも中止をリクエストする。
+        待っているレスポンスはデコードせずに捨てる(接続は閉じる)。タスクが終わるまでの秒数を返す
+        """
+        started = time.perf_counter()
+        # キャンセルするとバックエンドが空くので、先に中止を送る先を決めておく
+        busy = self._busy_backends()
+        task.cancel()
+        await asyncio.gather(self.interrupt_generation(busy), asyncio.wait([task]))
+        elapsed = time.perf_counter() - started
+        _LOG.info(f'中止をリクエストしてから生成が止まるまで: {elapsed * 1000:.0f} ms')
+        return elapsed
 
     async def get_generation_progress(self) -> Optional[float]:
-        "生成の進行度合い(0-1)を返す。生成中でなければNone"
-        response = await self.client.get('progress?skip_current_image=true')
-        response.raise_for_status()
-        progress = response.json()['progress']
-        if progress:
-            return progress
+        "生成を依頼しているバックエンドの進行度合い(0-1)の平均を返す。生成中でなければNone"
+        results = await asyncio.gather(*[ backend.get_generation_progress() for backend in self._busy_backends() ], return_exceptions=True)
+        progresses = [ progress for progress in results if isinstance(progress, (int, float)) ]
+        for error in results:
+            if isinstance(error, BaseException):
+                _LOG.debug(f'進行状況を取得できません: {error!r}')
+        if progresses:
+            return sum(progresses) / len(progresses)
+
+    async def warm_up(self, n_connections:int=2, image_size:int=64, **kwargs) -> float:
+        """
+        使えるバックエンドごとに接続をn_connections本開いておき、小さな画像を1ステップだけ生成して、モデルをGPUに読み込ませておく。
+        最初の生成が、2回目以降と同じくらいの時間で済むようにする。かかった秒数を返す
+        """
+        context = Image.new('RGB', (image_size // 2, image_size), (128, 128, 128))
+        async def _warm_up(backend:Backend):
+            started = time.perf_counter()
+            # 同時にリクエストすれば、それぞれ別の接続が開かれてプールに残る
+            await asyncio.gather(*[ backend.get_generation_progress() for _ in range(n_connections) ])
+            connected = time.perf_counter()
+            await self._generate(context, Direction.RIGHT, mask_blur=0, image_size=image_size, backends=[backend], **(dict(steps=1) | kwargs))
+            finished = time.perf_counter()
+            _LOG.info(f'{backend.base_url}をウォームアップしました 接続: {(connected - started) * 1000:.0f} ms 生成: {(finished - connected) * 1000:.0f} ms')
+
+        started = time.perf_counter()
+        await asyncio.gather(*[ _warm_up(backend) for backend in self.backends if backend.healthy ])
+        return time.perf_counter() - started
 
     async def get_sampler_or_scheduler_names(self, kind:Literal['samplers', 'schedulers']) -> list[str]:
-        response = await self.client.get(kind)
-        if response.is_success:
-            root = response.json()
-            return [ item['name'] for item in root ]
-        else:
+        "使えるバックエンドのすべてにある名前を、最初のバックエンドの順に返す(アクセスできないバックエンドは無視する)"
+        results = await asyncio.gather(*[ backend.get_sampler_or_scheduler_names(kind) for backend in self.backends if backend.healthy ], return_exceptions=True)
+        lists = [ names for names in results if isinstance(names, list) and names ] # 一覧を返さないバックエンドも無視する
+        if not lists:
+            errors = [ error for error in results if isinstance(error, BaseException) ]
+            if errors and len(errors) == len(results):
+                raise errors[0]
             return []
+        common = set(lists[0]).intersection(*lists[1:])
+        return [ name for name in lists[0] if name in common ]
 
 
 DEFAULT_OPTIONS = {